@@ -66,14 +66,14 @@ class GMM(object):
                 self.conf.get('directories', 'expdir') + '/' + self.name,
                 self.conf.get('directories', 'expdir') + '/' + self.name))
 
-        #convert alignments (transition-ids) to pdf-ids
+        #convert alignments (transition-ids) to pdf-ids and write them as
+        #binary int32 vectors
+        alidir = self.conf.get('directories', 'expdir') + '/' + self.name
         for i in range(int(self.conf.get('general', 'num_jobs'))):
-            os.system('''gunzip -c %s/ali/ali.%d.gz | ali-to-pdf
-                %s/ali/final.mdl ark:- ark,t:- | gzip >  %s/ali/pdf.%d.gz''' % (
-                    self.conf.get('directories', 'expdir') + '/' + self.name,
-                    i+1, self.conf.get('directories', 'expdir') + '/'
-                    + self.name, self.conf.get('directories', 'expdir')
-                    + '/' + self.name, i+1))
+            os.system(('gunzip -c %s/ali/ali.%d.gz | ali-to-pdf '
+                       '%s/ali/final.mdl ark:- '
+                       'ark,scp:%s/ali/pdf.%d.ark,%s/ali/pdf.%d.scp') % (
+                           alidir, i+1, alidir, alidir, i+1, alidir, i+1))
 
         #go back to working dir
         os.chdir(current_dir)
@@ -4,7 +4,7 @@ run this file to go through the neural net training procedure, look at the confi
 import os
 from six.moves import configparser
 from neuralNetworks import nnet
-from processing import ark, prepare_data, feature_reader, batchdispenser, target_coder
+from processing import ark, prepare_data, feature_reader, feature_store, batchdispenser, target_coder, readfiles
 from kaldi import gmm
 
 #here you can set which steps should be executed. If a step has been executed in the past the result have been saved and the step does not have to be executed again (if nothing has changed)
@@ -118,6 +118,7 @@ if TEST_LDA:
 reader = ark.ArkReader(config.get('directories', 'train_features') + '/' + config.get('dnn-features', 'name') + '/feats.scp')
 _, features, _ = reader.read_next_utt()
 input_dim = features.shape[1]
+reader.close()
 
 #get number of output labels
 numpdfs = open(config.get('directories', 'expdir') + '/' + config.get('nnet', 'gmm_name') + '/graph/num_pdfs')
@@ -128,29 +129,50 @@ numpdfs.close()
 #create the neural net
 nnet = nnet.Nnet(config, input_dim, num_labels)
 
+#the feature readers don't splice the features if the neural net splices them
+context_width = 0 if config.get('nnet', 'splice_in_graph') == 'True' else int(config.get('nnet', 'context_width'))
+
 if TRAIN_NNET:
 
+    #if the examples are shuffled every epoch they are read in the order of the archives
+    feats_name = 'feats' if config.get('nnet', 'shuffle') == 'epoch' else 'feats_shuffled'
+
     #only shuffle if we start with initialisation
     if config.get('nnet', 'starting_step') == '0':
         #shuffle the examples on disk
-        print '------- shuffling examples ----------'
-        prepare_data.shuffle_examples(config.get('directories', 'train_features') + '/' +  config.get('dnn-features', 'name'))
-
-    #put all the alignments in one file
-    alifiles = [config.get('directories', 'expdir') + '/' + config.get('nnet', 'gmm_name') + '/ali/pdf.' + str(i+1) + '.gz' for i in range(int(config.get('general', 'num_jobs')))]
-    alifile = config.get('directories', 'expdir') + '/' + config.get('nnet', 'gmm_name') + '/ali/pdf.all'
+        if config.get('nnet', 'shuffle') != 'epoch':
+            print '------- shuffling examples ----------'
+            prepare_data.shuffle_examples(config.get('directories', 'train_features') + '/' +  config.get('dnn-features', 'name'))
+
+        #copy the features into one contiguous memory mapped feature store
+        if config.get('nnet', 'feature_store') == 'True':
+            print '------- creating feature store ----------'
+            feature_store.convert(config.get('directories', 'train_features') + '/' +  config.get('dnn-features', 'name') + '/' + feats_name + '.scp', config.get('directories', 'train_features') + '/' +  config.get('dnn-features', 'name') + '/' + feats_name + '_store')
+
+    #put all the alignments in one scp file
+    alifiles = [config.get('directories', 'expdir') + '/' + config.get('nnet', 'gmm_name') + '/ali/pdf.' + str(i+1) + '.scp' for i in range(int(config.get('general', 'num_jobs')))]
+    alifile = config.get('directories', 'expdir') + '/' + config.get('nnet', 'gmm_name') + '/ali/pdf.scp'
     os.system('cat %s > %s' % (' '.join(alifiles), alifile))
 
     #create a feature reader
     featdir = config.get('directories', 'train_features') + '/' +  config.get('dnn-features', 'name')
     with open(featdir + '/maxlength', 'r') as fid:
         max_input_length = int(fid.read())
-    featreader = feature_reader.FeatureReader(featdir + '/feats_shuffled.scp', featdir + '/cmvn.scp', featdir + '/utt2spk', int(config.get('nnet', 'context_width')), max_input_length)
+    featfile = featdir + '/' + feats_name + ('_store' if config.get('nnet', 'feature_store') == 'True' else '.scp')
+    featreader = feature_reader.FeatureReader(featfile, featdir + '/cmvn.scp', featdir + '/utt2spk', context_width, max_input_length, prefetch=int(config.get('nnet', 'prefetch')), splice_mode=config.get('nnet', 'splice_mode'), cmvn_mode=config.get('nnet', 'cmvn_mode'), cmvn_window=int(config.get('nnet', 'cmvn_window')))
 
     #create a target coder
     coder = target_coder.AlignmentCoder(lambda x, y: x, num_labels)
 
-    dispenser = batchdispenser.AlignmentBatchDispenser(featreader, coder, int(config.get('nnet', 'batch_size')), alifile)
+    #the DNN can be trained with minibatches of shuffled frames or with batches of utterances
+    if config.get('nnet', 'frame_batches') == 'True':
+        dispenser = batchdispenser.FrameBatchDispenser(featreader, coder, int(config.get('nnet', 'frame_batch_size')), alifile, int(config.get('nnet', 'frame_buffer_size')))
+    else:
+        dispenser = batchdispenser.AlignmentBatchDispenser(featreader, coder, int(config.get('nnet', 'batch_size')), alifile)
+
+        #prepare the training batches in worker processes
+        if int(config.get('nnet', 'num_workers')) > 0:
+            dispenser = batchdispenser.ParallelBatchDispenser(dispenser, int(config.get('nnet', 'num_workers')))
 
     #train the neural net
     print '------- training neural net ----------'
@@ -171,15 +193,19 @@ if TEST_NNET:
     #create a feature reader
     with open(featdir + '/maxlength', 'r') as fid:
         max_length = int(fid.read())
-    featreader = feature_reader.FeatureReader(featdir + '/feats.scp', featdir + '/cmvn.scp', featdir + '/utt2spk', int(config.get('nnet', 'context_width')), max_length)
+    featreader = feature_reader.FeatureReader(featdir + '/feats.scp', featdir + '/cmvn.scp', featdir + '/utt2spk', context_width, max_length, prefetch=int(config.get('nnet', 'prefetch')), splice_mode=config.get('nnet', 'splice_mode'), cmvn_mode=config.get('nnet', 'cmvn_mode'), cmvn_window=int(config.get('nnet', 'cmvn_window')))
 
-    #create an ark writer for the likelihoods
-    if os.path.isfile(decodedir + '/likelihoods.ark'):
-        os.remove(decodedir + '/likelihoods.ark')
-    writer = ark.ArkWriter(decodedir + '/feats.scp', decodedir + '/likelihoods.ark')
+    #create an ark writer for the likelihoods, the likelihoods are only sharded (by speaker) if requested
+    num_shards = int(config.get('nnet', 'likelihood_shards'))
+    prepare_data.remove_archives(decodedir + '/likelihoods.ark', num_shards)
+    if num_shards > 1:
+        writer = ark.ArkWriter(decodedir + '/feats.scp', decodedir + '/likelihoods.ark', num_shards=num_shards, shard_by='speaker', utt2spk=readfiles.read_utt2spk(featdir + '/utt2spk'))
+    else:
+        writer = ark.ArkWriter(decodedir + '/feats.scp', decodedir + '/likelihoods.ark')
 
     #decode with te neural net
     nnet.decode(featreader, writer)
+    featreader.close()
 
     print '------- decoding testing sets ----------'
     #copy the gmm model and some files to speaker mapping to the decoding dir
@@ -11,7 +11,7 @@ class DNN(Classifier):
     '''This class is a graph for feedforward fully connected neural nets.'''
 
     def __init__(self, output_dim, num_layers, num_units, activation,
-                 layerwise_init=True):
+                 layerwise_init=True, context_width=0):
         '''
         DNN constructor
 
@@ -23,6 +23,9 @@ class DNN(Classifier):
             layerwise_init: if True the layers will be added one by one,
                 otherwise all layers will be added to the network in the
                 beginning
+            context_width: the inputs are spliced in the graph with this
+                context width, so the network can be fed unspliced features, if
+                0 the inputs are not spliced
         '''
 
         #super constructor
@@ -33,6 +36,7 @@ class DNN(Classifier):
         self.num_units = num_units
         self.activation = activation
         self.layerwise_init = layerwise_init
+        self.context_width = context_width
 
     def __call__(self, inputs, seq_length, is_training=False, reuse=False,
                  scope=None):
@@ -69,6 +73,10 @@ class DNN(Classifier):
 
             #do the forward computation
 
+            #splice the inputs
+            if self.context_width > 0:
+                inputs = seq_convertors.splice(inputs, self.context_width)
+
             #convert the sequential data to non sequential data
             nonseq_inputs = seq_convertors.seq2nonseq(inputs, seq_length)
 
@@ -17,7 +17,8 @@ def seq2nonseq(tensorlist, seq_length, name=None):
         tensorlist: the sequential data, wich is a list containing an N x F
             tensor for each time step where N is the batch size and F is the
             input dimension
-        seq_length: a vector containing the sequence lengths
+        seq_length: a vector containing the sequence lengths, if None all
+            sequences have the maximal length
         name: [optional] the name of the operation
 
     Returns:
@@ -26,6 +27,10 @@ def seq2nonseq(tensorlist, seq_length, name=None):
     '''
 
     with tf.name_scope(name or 'seq2nonseq'):
+        #without sequence lengths the time steps are concatenated
+        if seq_length is None:
+            return tf.concat(0, tensorlist)
+
         #convert the list for each time step to a list for each sequence
         sequences = tf.unpack(tf.pack(tensorlist), axis=1)
 
@@ -45,7 +50,9 @@ def nonseq2seq(tensor, seq_length, length, name=None):
     Args:
         tensor: non sequential data, which is a TxF tensor where T is the sum of
             all sequence lengths
-        seq_length: a vector containing the sequence lengths
+        seq_length: a vector containing the sequence lengths, if None all
+            sequences have the maximal length and the data is in the order of
+            seq2nonseq without sequence lengths
         length: the constant length of the output sequences
         name: [optional] the name of the operation
 
@@ -56,6 +63,11 @@ def nonseq2seq(tensor, seq_length, length, name=None):
     '''
 
     with tf.name_scope(name or'nonseq2seq'):
+        #without sequence lengths the tensor contains the time steps one after
+        #the other
+        if seq_length is None:
+            return tf.split(0, length, tensor)
+
         #get the cumulated sequence lengths to specify the positions in tensor
         cum_seq_length = tf.concat(0, [tf.constant([0]), tf.cumsum(seq_length)])
 
@@ -78,3 +90,40 @@ def nonseq2seq(tensor, seq_length, length, name=None):
         tensorlist = tf.unpack(tf.pack(sequences), axis=1)
 
     return tensorlist
+
+def splice(tensorlist, context_width, name=None):
+    '''
+    Splice sequential data, every time step is concatenated with the
+    context_width time steps to its left and right, the sequences are zero
+    padded at the edges
+
+    The sequences must be zero padded after their sequence length (as is done
+    when feeding the data), so the right context at the end of a sequence is
+    zero.
+
+    Args:
+        tensorlist: the sequential data, wich is a list containing an N x F
+            tensor for each time step where N is the batch size and F is the
+            input dimension
+        context_width: how many time steps to the left and right should be
+            concatenated
+        name: [optional] the name of the operation
+
+    Returns:
+        sequential data, wich is a list containing an N x (2*context_width+1)F
+        tensor for each time step
+    '''
+
+    with tf.name_scope(name or 'splice'):
+        #pad the time dimension of the data with zeros
+        tensor = tf.pad(tf.pack(tensorlist),
+                        [[context_width, context_width], [0, 0], [0, 0]])
+
+        #concatenate shifted copies of the data along the feature dimension
+        length = len(tensorlist)
+        tensor = tf.concat(2, [tensor[k:k+length]
+                               for k in range(2*context_width+1)])
+
+        tensorlist = tf.unpack(tensor)
+
+    return tensorlist
@@ -8,7 +8,7 @@ import numpy as np
 import tensorflow as tf
 import classifiers.activation
 from classifiers.dnn import DNN
-from trainer import CrossEnthropyTrainer
+from trainer import CrossEnthropyTrainer, FrameTrainer
 from decoder import Decoder
 
 class Nnet(object):
@@ -36,8 +36,20 @@ class Nnet(object):
         if not os.path.isdir(self.conf['savedir'] + '/training'):
             os.mkdir(self.conf['savedir'] + '/training')
 
-        #compute the input_dimension of the spliced features
-        self.input_dim = input_dim * (2*int(self.conf['context_width']) + 1)
+        #compute the input_dimension of the spliced features, if the features
+        #are spliced in the graph the network is fed the unspliced features
+        if self.conf['splice_in_graph'] == 'True':
+            if self.conf['frame_batches'] == 'True':
+                raise Exception('frame level training requires spliced '
+                                'features')
+            if self.conf['splice_mode'] != 'zeros':
+                raise Exception('splicing in the graph only supports zero '
+                                'padding')
+            self.input_dim = input_dim
+            context_width = int(self.conf['context_width'])
+        else:
+            self.input_dim = input_dim * (2*int(self.conf['context_width']) + 1)
+            context_width = 0
 
         if self.conf['batch_norm'] == 'True':
             activation = classifiers.activation.Batchnorm(None)
@@ -75,26 +87,53 @@ class Nnet(object):
         self.dnn = DNN(
             num_labels, int(self.conf['num_hidden_layers']),
             int(self.conf['num_hidden_units']), activation,
-            int(self.conf['add_layer_period']) > 0)
+            int(self.conf['add_layer_period']) > 0, context_width)
 
     def train(self, dispenser):
         '''
         Train the neural network
 
         Args:
-            dispenser: a batchdispenser for training
+            dispenser: a batchdispenser for training, a FrameBatchDispenser
+                if the network is trained on frame level
         '''
 
-        #get the validation set
-        val_data, val_labels = zip(
-            *[dispenser.get_batch()
-              for _ in range(int(self.conf['valid_batches']))])
-
-        val_data = list(itertools.chain.from_iterable(val_data))
-        val_labels = list(itertools.chain.from_iterable(val_labels))
+        frame_level = self.conf['frame_batches'] == 'True'
+        sort_batches = self.conf['sort_batches'] == 'True' and not frame_level
+
+        #shuffle the utterances in memory every epoch, the validation set is
+        #taken from the first epoch
+        if self.conf['shuffle'] == 'epoch' and not sort_batches:
+            dispenser.shuffle(block_size=int(self.conf['shuffle_block_size']),
+                              buffer_size=int(
+                                  self.conf['shuffle_buffer_size']))
+
+        #get the validation set, on frame level the validation set contains
+        #the same number of whole utterances and is read before the shuffle
+        #buffer is filled, so the split is at the end of the validation set
+        if frame_level:
+            val_data, val_labels = dispenser.get_utterances(
+                int(self.conf['valid_batches'])*int(self.conf['batch_size']))
+        else:
+            val_data, val_labels = zip(
+                *[dispenser.get_batch()
+                  for _ in range(int(self.conf['valid_batches']))])
+            val_data = list(itertools.chain.from_iterable(val_data))
+            val_labels = list(itertools.chain.from_iterable(val_labels))
 
         dispenser.split()
 
+        #put utterances of similar length together in the batches
+        if sort_batches:
+            dispenser.sort_batches()
+
+        #the minibatches are padded to the length of the smallest bucket they
+        #fit in
+        if int(self.conf['num_buckets']) > 1 and not frame_level:
+            buckets = dispenser.bucket_lengths(int(self.conf['num_buckets']))
+        else:
+            buckets = None
+
         #compute the total number of steps
         num_steps = int(dispenser.num_batches *int(self.conf['num_epochs']))
 
@@ -103,9 +142,14 @@ class Nnet(object):
                 - int(self.conf['starting_step'])
                 % int(self.conf['check_freq']))
 
-        #go to the point in the database where the training was at checkpoint
-        for _ in range(step):
-            dispenser.skip_batch()
+        #go to the point in the database where the training was at checkpoint,
+        #the position is stored with the checkpoint
+        checkpoint = self.conf['savedir'] + '/training/step' + str(step)
+        if step > 0 and os.path.isfile(checkpoint + '_dispenser.npz'):
+            dispenser.restore_state(checkpoint + '_dispenser.npz')
+        else:
+            for _ in range(step):
+                dispenser.skip_batch()
 
         if self.conf['numutterances_per_minibatch'] == '-1':
             numutterances_per_minibatch = dispenser.size
@@ -114,12 +158,18 @@ class Nnet(object):
                 self.conf['numutterances_per_minibatch'])
 
         #put the DNN in a training environment
-        trainer = CrossEnthropyTrainer(
-            self.dnn, self.input_dim, dispenser.max_input_length,
-            dispenser.max_target_length,
-            float(self.conf['initial_learning_rate']),
-            float(self.conf['learning_rate_decay']),
-            num_steps, numutterances_per_minibatch)
+        if frame_level:
+            trainer = FrameTrainer(
+                self.dnn, self.input_dim,
+                float(self.conf['initial_learning_rate']),
+                float(self.conf['learning_rate_decay']), num_steps)
+        else:
+            trainer = CrossEnthropyTrainer(
+                self.dnn, self.input_dim, dispenser.max_input_length,
+                dispenser.max_target_length,
+                float(self.conf['initial_learning_rate']),
+                float(self.conf['learning_rate_decay']),
+                num_steps, numutterances_per_minibatch, buckets)
 
         #start the visualization if it is requested
         if self.conf['visualise'] == 'True':
@@ -147,6 +197,8 @@ class Nnet(object):
                 validation_step = step
                 trainer.save_trainer(self.conf['savedir']
                                      + '/training/validated')
+                dispenser.save_state(self.conf['savedir']
+                                     + '/training/validated_dispenser.npz')
                 num_retries = 0
 
             #start the training iteration
@@ -170,6 +222,7 @@ class Nnet(object):
 
                     current_loss = trainer.evaluate(val_data, val_labels)
                     print 'validation loss at step %d: %f' %(step, current_loss)
+                    print 'padding efficiency: %f' % trainer.padding_efficiency
 
                     if self.conf['valid_adapt'] == 'True':
                         #if the loss increased, half the learning rate and go
@@ -177,8 +230,9 @@ class Nnet(object):
                         if current_loss > validation_loss:
 
                             #go back in the dispenser
-                            for _ in range(step-validation_step):
-                                dispenser.return_batch()
+                            dispenser.restore_state(
+                                self.conf['savedir']
+                                + '/training/validated_dispenser.npz')
 
                             #load the validated model
                             trainer.restore_trainer(self.conf['savedir']
@@ -205,6 +259,9 @@ class Nnet(object):
                             num_retries = 0
                             trainer.save_trainer(self.conf['savedir']
                                                  + '/training/validated')
+                            dispenser.save_state(
+                                self.conf['savedir']
+                                + '/training/validated_dispenser.npz')
 
                 #add a layer if its required
                 if int(self.conf['add_layer_period']) > 0:
@@ -226,12 +283,18 @@ class Nnet(object):
                         validation_step = step
                         trainer.save_trainer(self.conf['savedir']
                                              + '/training/validated')
+                        dispenser.save_state(
+                            self.conf['savedir']
+                            + '/training/validated_dispenser.npz')
                         num_retries = 0
 
                 #save the model if at checkpoint
                 if step%int(self.conf['check_freq']) == 0:
                     trainer.save_trainer(self.conf['savedir'] + '/training/step'
                                          + str(step))
+                    dispenser.save_state(self.conf['savedir']
+                                         + '/training/step' + str(step)
+                                         + '_dispenser.npz')
 
 
             #save the final model
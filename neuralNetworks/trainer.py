@@ -2,6 +2,7 @@
 neural network trainer environment'''
 
 from abc import ABCMeta, abstractmethod
+import bisect
 import tensorflow as tf
 import numpy as np
 from classifiers import seq_convertors
@@ -12,7 +13,7 @@ class Trainer(object):
 
     def __init__(self, classifier, input_dim, max_input_length,
                  max_target_length, init_learning_rate, learning_rate_decay,
-                 num_steps, numutterances_per_minibatch):
+                 num_steps, numutterances_per_minibatch, buckets=None):
         '''
         NnetTrainer constructor, creates the training graph
 
@@ -27,195 +28,286 @@ class Trainer(object):
             num_steps: the total number of steps that will be taken
             numutterances_per_minibatch: determines how many utterances are
                 processed at a time to limit memory usage
+            buckets: a list of input lengths, a graph is created for every
+                bucket length (sharing the variables) and every minibatch is
+                padded to the smallest bucket it fits in. The targets of a
+                bucket are padded to the bucket length (at most
+                max_target_length), so the target sequences should not be
+                longer than the input sequences. If None all minibatches are
+                padded to max_input_length
         '''
 
         self.numutterances_per_minibatch = numutterances_per_minibatch
         self.max_input_length = max_input_length
         self.max_target_length = max_target_length
 
+        #the input and target lengths of the buckets
+        self.buckets = sorted(set([length for length in buckets or []
+                                   if length < max_input_length]
+                                  + [max_input_length]))
+        self.target_buckets = [min(length, max_target_length)
+                               for length in self.buckets]
+
+        #the number of frames and padded frames that have been fed for
+        #training
+        self.num_frames = 0
+        self.num_padded_frames = 0
+
+        #the validation set and its padded minibatches, the validation set is
+        #only padded the first time it is evaluated
+        self.valid_inputs = None
+        self.valid_targets = None
+        self.valid_minibatches = None
+
         #create the graph
         self.graph = tf.Graph()
 
         #define the placeholders in the graph
         with self.graph.as_default():
 
-            #create the inputs placeholder
-            self.inputs = tf.placeholder(
-                tf.float32, shape=[max_input_length,
-                                   numutterances_per_minibatch, input_dim],
-                name='inputs')
-
-            #split the 3D input tensor in a list of batch_size*input_dim tensors
-            split_inputs = tf.unpack(self.inputs)
-
-            #reference labels
-            self.targets = tf.placeholder(
-                tf.int32, shape=[max_target_length,
-                                 numutterances_per_minibatch, 1],
-                name='targets')
-
-            #split the 3D targets tensor in a list of batch_size*input_dim
-            #tensors
-            split_targets = tf.unpack(self.targets)
-
-            #the length of all the input sequences
-            self.input_seq_length = tf.placeholder(
-                tf.int32, shape=[numutterances_per_minibatch],
-                name='input_seq_length')
-
-            #the length of all the output sequences
-            self.target_seq_length = tf.placeholder(
-                tf.int32, shape=[numutterances_per_minibatch],
-                name='output_seq_length')
+            self.inputs = []
+            self.targets = []
+            self.input_seq_length = []
+            self.target_seq_length = []
+            split_targets = []
+            trainlogits = []
+            logits = []
+            logit_seq_length = []
+            bucket_update_ops = []
+
+            for bucket, length in enumerate(self.buckets):
+
+                #create the inputs placeholder
+                self.inputs.append(tf.placeholder(
+                    tf.float32, shape=[length, numutterances_per_minibatch,
+                                       input_dim],
+                    name='inputs%d' % length))
+
+                #split the 3D input tensor in a list of batch_size*input_dim
+                #tensors
+                split_inputs = tf.unpack(self.inputs[bucket])
+
+                #reference labels
+                self.targets.append(tf.placeholder(
+                    tf.int32, shape=[self.target_buckets[bucket],
+                                     numutterances_per_minibatch, 1],
+                    name='targets%d' % length))
+
+                #split the 3D targets tensor in a list of batch_size*input_dim
+                #tensors
+                split_targets.append(tf.unpack(self.targets[bucket]))
+
+                #the length of all the input sequences
+                self.input_seq_length.append(tf.placeholder(
+                    tf.int32, shape=[numutterances_per_minibatch],
+                    name='input_seq_length%d' % length))
+
+                #the length of all the output sequences
+                self.target_seq_length.append(tf.placeholder(
+                    tf.int32, shape=[numutterances_per_minibatch],
+                    name='output_seq_length%d' % length))
+
+                #remember the update operations that already exist so only the
+                #ones of this bucket are run when the bucket is fed
+                existing_update_ops = tf.get_collection(
+                    tf.GraphKeys.UPDATE_OPS)
+
+                #compute the training outputs of the nnetgraph, the variables
+                #are created for the first bucket and shared by the others
+                (bucket_logits, bucket_seq_length, modelsaver,
+                 control_ops) = classifier(
+                     split_inputs, self.input_seq_length[bucket],
+                     is_training=True, reuse=bucket > 0, scope='Classifier')
+                trainlogits.append(bucket_logits)
+                logit_seq_length.append(bucket_seq_length)
+
+                if bucket == 0:
+                    self.modelsaver = modelsaver
+                    self.control_ops = control_ops
+
+                bucket_update_ops.append(
+                    [op for op in tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+                     if op not in existing_update_ops])
+
+                #compute the validation output of the nnetgraph
+                logits.append(classifier(
+                    split_inputs, self.input_seq_length[bucket],
+                    is_training=False, reuse=True, scope='Classifier')[0])
+
+            #compute the training and validation loss of every bucket
+            with tf.name_scope('train'):
+                train_losses = [
+                    self.compute_loss(split_targets[bucket],
+                                      trainlogits[bucket],
+                                      logit_seq_length[bucket],
+                                      self.target_seq_length[bucket])
+                    for bucket in range(len(self.buckets))]
 
-            #compute the training outputs of the nnetgraph
-            trainlogits, logit_seq_length, self.modelsaver, self.control_ops = (
-                classifier(split_inputs, self.input_seq_length, is_training=True
-                           , reuse=False, scope='Classifier'))
+            with tf.name_scope('valid'):
+                valid_losses = [
+                    self.compute_loss(split_targets[bucket], logits[bucket],
+                                      logit_seq_length[bucket],
+                                      self.target_seq_length[bucket])
+                    for bucket in range(len(self.buckets))]
+
+            self.create_training_ops(
+                train_losses, valid_losses, bucket_update_ops,
+                [tf.reduce_sum(target_seq_length)
+                 for target_seq_length in self.target_seq_length],
+                init_learning_rate, learning_rate_decay, num_steps)
 
-            #compute the validation output of the nnetgraph
-            logits, _, _, _ = classifier(split_inputs, self.input_seq_length,
-                                         is_training=False, reuse=True,
-                                         scope='Classifier')
+        #specify that the graph can no longer be modified after this point
+        self.graph.finalize()
 
-            #get a list of trainable variables in the decoder graph
-            params = tf.trainable_variables()
+        #start without visualisation
+        self.summarywriter = None
 
-            #add the variables and operations to the graph that are used for
-            #training
+    def create_training_ops(self, train_losses, valid_losses, update_ops,
+                            frame_counts, init_learning_rate,
+                            learning_rate_decay, num_steps):
+        '''
+        create the variables and operations that are used for training
 
-            #total number of steps
-            nsteps = tf.constant(num_steps, dtype=tf.int32, name='num_steps')
+        the losses are given for every part of the graph that can be fed
+        separately (e.g. every bucket), for every part an operation is created
+        that accumulates the gradients and the loss and one that accumulates
+        the validation loss
 
-            #the total loss of the entire batch
-            batch_loss = tf.get_variable(
-                'batch_loss', [], dtype=tf.float32,
-                initializer=tf.constant_initializer(0), trainable=False)
+        Args:
+            train_losses: a list with the training loss of every part
+            valid_losses: a list with the validation loss of every part
+            update_ops: a list with a list of the update operations (e.g. of
+                batch normalisation) of every part
+            frame_counts: a list with the number of frames of every part
+            init_learning_rate: the initial learning rate
+            learning_rate_decay: the parameter for exponential learning rate
+                decay
+            num_steps: the total number of steps that will be taken
+        '''
 
-            with tf.variable_scope('train_variables'):
+        #get a list of trainable variables in the decoder graph
+        params = tf.trainable_variables()
 
-                #the amount of steps already taken
-                self.global_step = tf.get_variable(
-                    'global_step', [], dtype=tf.int32,
-                    initializer=tf.constant_initializer(0), trainable=False)
+        #add the variables and operations to the graph that are used for
+        #training
 
-                #a variable to scale the learning rate (used to reduce the
-                #learning rate in case validation performance drops)
-                learning_rate_fact = tf.get_variable(
-                    'learning_rate_fact', [],
-                    initializer=tf.constant_initializer(1.0), trainable=False)
+        #total number of steps
+        nsteps = tf.constant(num_steps, dtype=tf.int32, name='num_steps')
 
-                #compute the learning rate with exponential decay and scale with
-                #the learning rate factor
-                learning_rate = tf.train.exponential_decay(
-                    init_learning_rate, self.global_step, nsteps,
-                    learning_rate_decay) * learning_rate_fact
+        #the total loss of the entire batch
+        batch_loss = tf.get_variable(
+            'batch_loss', [], dtype=tf.float32,
+            initializer=tf.constant_initializer(0), trainable=False)
 
-                #create the optimizer
-                optimizer = tf.train.AdamOptimizer(learning_rate)
+        with tf.variable_scope('train_variables'):
 
-            #for every parameter create a variable that holds its gradients
-            with tf.variable_scope('gradients'):
-                grads = [tf.get_variable(
-                    param.op.name, param.get_shape().as_list(),
-                    initializer=tf.constant_initializer(0),
-                    trainable=False) for param in params]
+            #the amount of steps already taken
+            self.global_step = tf.get_variable(
+                'global_step', [], dtype=tf.int32,
+                initializer=tf.constant_initializer(0), trainable=False)
 
-            with tf.name_scope('train'):
-                #the total number of frames that are used in the batch
-                num_frames = tf.get_variable(
-                    name='num_frames', shape=[], dtype=tf.int32,
-                    initializer=tf.constant_initializer(0), trainable=False)
+            #a variable to scale the learning rate (used to reduce the
+            #learning rate in case validation performance drops)
+            learning_rate_fact = tf.get_variable(
+                'learning_rate_fact', [],
+                initializer=tf.constant_initializer(1.0), trainable=False)
+
+            #compute the learning rate with exponential decay and scale with
+            #the learning rate factor
+            learning_rate = tf.train.exponential_decay(
+                init_learning_rate, self.global_step, nsteps,
+                learning_rate_decay) * learning_rate_fact
+
+            #create the optimizer
+            optimizer = tf.train.AdamOptimizer(learning_rate)
+
+        #for every parameter create a variable that holds its gradients
+        with tf.variable_scope('gradients'):
+            grads = [tf.get_variable(
+                param.op.name, param.get_shape().as_list(),
+                initializer=tf.constant_initializer(0),
+                trainable=False) for param in params]
+
+        with tf.name_scope('train'):
+            #the total number of frames that are used in the batch
+            num_frames = tf.get_variable(
+                name='num_frames', shape=[], dtype=tf.int32,
+                initializer=tf.constant_initializer(0), trainable=False)
 
-                #operation to update num_frames
-                #pylint: disable=E1101
-                update_num_frames = num_frames.assign_add(
-                    tf.reduce_sum(self.target_seq_length))
+            #operation to half the learning rate
+            self.halve_learningrate_op = learning_rate_fact.assign(
+                learning_rate_fact/2).op
 
-                #compute the training loss
-                loss = self.compute_loss(
-                    split_targets, trainlogits, logit_seq_length,
-                    self.target_seq_length)
+            #create an operation to initialise the gradients
+            self.init_grads = tf.initialize_variables(grads)
 
-                #operation to half the learning rate
-                self.halve_learningrate_op = learning_rate_fact.assign(
-                    learning_rate_fact/2).op
+            #the operation to initialise the batch loss
+            self.init_loss = batch_loss.initializer #pylint: disable=E1101
 
-                #create an operation to initialise the gradients
-                self.init_grads = tf.initialize_variables(grads)
+            #the operation to initialize the num_frames
+            #pylint: disable=E1101
+            self.init_num_frames = num_frames.initializer
 
-                #the operation to initialise the batch loss
-                self.init_loss = batch_loss.initializer #pylint: disable=E1101
+            #operations to update num_frames for every part
+            #pylint: disable=E1101
+            update_num_frames = [num_frames.assign_add(frame_count)
+                                 for frame_count in frame_counts]
 
-                #the operation to initialize the num_frames
-                #pylint: disable=E1101
-                self.init_num_frames = num_frames.initializer
+            self.update_gradients_op = []
+            for part, loss in enumerate(train_losses):
 
                 #compute the gradients of the batch
                 batchgrads = tf.gradients(loss, params)
 
-                #create an operation to update the batch loss
-                #pylint: disable=E1101
-                self.update_loss = batch_loss.assign_add(loss)
-
-                #create an operation to update the gradients, the batch_loss
-                #and do all other update ops
+                #create an operation to update the gradients, the
+                #batch_loss and do all other update ops of the part
                 #pylint: disable=E1101
-                update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-                self.update_gradients_op = tf.group(
+                self.update_gradients_op.append(tf.group(
                     *([grads[p].assign_add(batchgrads[p])
-                       for p in range(len(grads)) if batchgrads[p] is not None]
-                      + [self.update_loss] + update_ops + [update_num_frames]),
-                    name='update_gradients')
-
-                #create an operation to apply the gradients
+                       for p in range(len(grads))
+                       if batchgrads[p] is not None]
+                      + [batch_loss.assign_add(loss)]
+                      + update_ops[part] + [update_num_frames[part]]),
+                    name='update_gradients'))
 
-                #average the gradients
-                meangrads = [tf.div(grad, tf.cast(num_frames, tf.float32),
-                                    name=grad.op.name) for grad in grads]
+            #create an operation to apply the gradients
 
-                #clip the gradients
-                meangrads = [tf.clip_by_value(grad, -1., 1.)
-                             for grad in meangrads]
+            #average the gradients
+            meangrads = [tf.div(grad, tf.cast(num_frames, tf.float32),
+                                name=grad.op.name) for grad in grads]
 
-                #apply the gradients
-                self.apply_gradients_op = optimizer.apply_gradients(
-                    [(meangrads[p], params[p]) for p in range(len(meangrads))],
-                    global_step=self.global_step, name='apply_gradients')
+            #clip the gradients
+            meangrads = [tf.clip_by_value(grad, -1., 1.)
+                         for grad in meangrads]
 
-            with tf.name_scope('valid'):
-                #compute the validation loss
-                valid_loss = self.compute_loss(
-                    split_targets, logits, logit_seq_length,
-                    self.target_seq_length)
+            #apply the gradients
+            self.apply_gradients_op = optimizer.apply_gradients(
+                [(meangrads[p], params[p]) for p in range(len(meangrads))],
+                global_step=self.global_step, name='apply_gradients')
 
-                #operation to update the validation loss
-                #pylint: disable=E1101
-                self.update_valid_loss = tf.group(
-                    *([batch_loss.assign_add(valid_loss), update_num_frames]))
-
-            #operation to compute the average loss in the batch
-            self.average_loss = batch_loss/tf.cast(num_frames, tf.float32)
-
-            # add an operation to initialise all the variables in the graph
-            self.init_op = tf.initialize_all_variables()
+        with tf.name_scope('valid'):
+            #operations to update the validation loss
+            #pylint: disable=E1101
+            self.update_valid_loss = [
+                tf.group(*([batch_loss.assign_add(valid_loss),
+                            update_num_frames[part]]))
+                for part, valid_loss in enumerate(valid_losses)]
 
-            #saver for the training variables
-            self.saver = tf.train.Saver(tf.get_collection(
-                tf.GraphKeys.VARIABLES, scope='train_variables'))
+        #operation to compute the average loss in the batch
+        self.average_loss = batch_loss/tf.cast(num_frames, tf.float32)
 
-            #create the summaries for visualisation
-            self.summary = tf.merge_summary(
-                [tf.histogram_summary(val.name, val)
-                 for val in params+meangrads]
-                + [tf.scalar_summary('loss', self.average_loss)])
+        # add an operation to initialise all the variables in the graph
+        self.init_op = tf.initialize_all_variables()
 
+        #saver for the training variables
+        self.saver = tf.train.Saver(tf.get_collection(
+            tf.GraphKeys.VARIABLES, scope='train_variables'))
 
-        #specify that the graph can no longer be modified after this point
-        self.graph.finalize()
-
-        #start without visualisation
-        self.summarywriter = None
+        #create the summaries for visualisation
+        self.summary = tf.merge_summary(
+            [tf.histogram_summary(val.name, val)
+             for val in params+meangrads]
+            + [tf.scalar_summary('loss', self.average_loss)])
 
     @abstractmethod
     def compute_loss(self, targets, logits, logit_seq_length,
@@ -272,64 +364,22 @@ class Trainer(object):
             the loss at this step
         '''
 
-        #get a list of sequence lengths
-        input_seq_length = [i.shape[0] for i in inputs]
-        output_seq_length = [t.shape[0] for t in targets]
-
-        #fill the inputs to have a round number of minibatches
-        added_inputs = (inputs + (len(inputs)%self.numutterances_per_minibatch)
-                        *[np.zeros([self.max_input_length,
-                                    inputs[0].shape[1]])])
-
-        added_targets = (
-            targets + (len(targets)%self.numutterances_per_minibatch)
-            *[np.zeros(self.max_target_length)])
+        #feed in the minibatches one by one and accumulate the gradients and
+        #loss
+        num_frames, num_padded_frames = self.feed(inputs, targets,
+                                                  self.update_gradients_op)
+        self.num_frames += num_frames
+        self.num_padded_frames += num_padded_frames
 
-        input_seq_length = (
-            input_seq_length
-            + ((len(input_seq_length)%self.numutterances_per_minibatch))*[0])
+        return self.apply_gradients()
 
-        output_seq_length = (
-            output_seq_length
-            + ((len(output_seq_length)%self.numutterances_per_minibatch))*[0])
-
-        #pad all the inputs qnd tqrgets to the max_length and put them in
-        #one array
-        padded_inputs = np.array([np.append(
-            i, np.zeros([self.max_input_length-i.shape[0], i.shape[1]]), 0)
-                                  for i in added_inputs])
-        padded_targets = np.array([np.append(
-            t, np.zeros(self.max_target_length-t.shape[0]), 0)
-                                   for t in added_targets])
-
-        #transpose the inputs and targets so they fit in the placeholders
-        padded_inputs = padded_inputs.transpose([1, 0, 2])
-        padded_targets = padded_targets.transpose()
-
-        #feed in the batches one by one and accumulate the gradients and loss
-        for k in range(len(added_inputs)/self.numutterances_per_minibatch):
-            batch_inputs = padded_inputs[:, k*self.numutterances_per_minibatch:
-                                         (k+1)*self.numutterances_per_minibatch,
-                                         :]
-
-            batch_targets = padded_targets[
-                :, k*self.numutterances_per_minibatch:
-                (k+1)*self.numutterances_per_minibatch]
-
-            batch_input_seq_length = input_seq_length[
-                k*self.numutterances_per_minibatch:
-                (k+1)*self.numutterances_per_minibatch]
-
-            batch_output_seq_length = output_seq_length[
-                k*self.numutterances_per_minibatch:
-                (k+1)*self.numutterances_per_minibatch]
+    def apply_gradients(self):
+        '''
+        apply the accumulated gradients to update the model parameters
 
-            #pylint: disable=E1101
-            self.update_gradients_op.run(
-                feed_dict={self.inputs:batch_inputs,
-                           self.targets:batch_targets[:, :, np.newaxis],
-                           self.input_seq_length:batch_input_seq_length,
-                           self.target_seq_length:batch_output_seq_length})
+        Returns:
+            the average loss of the accumulated batch
+        '''
 
         #apply the accumulated gradients to update the model parameters and
         #evaluate the loss
@@ -372,64 +422,27 @@ class Trainer(object):
         if inputs is None or targets is None:
             return None
 
-        #get a list of sequence lengths
-        input_seq_length = [i.shape[0] for i in inputs]
-        output_seq_length = [t.shape[0] for t in targets]
-
-        #fill the inputs to have a round number of minibatches
-        added_inputs = (inputs + (len(inputs)%self.numutterances_per_minibatch)
-                        *[np.zeros([self.max_input_length,
-                                    inputs[0].shape[1]])])
-
-        added_targets = (
-            targets + (len(targets)%self.numutterances_per_minibatch)
-            *[np.zeros(self.max_target_length)])
-
-        input_seq_length = (
-            input_seq_length
-            + ((len(input_seq_length)%self.numutterances_per_minibatch))*[0])
-
-        output_seq_length = (
-            output_seq_length
-            + ((len(output_seq_length)%self.numutterances_per_minibatch))*[0])
-
-        #pad all the inputs qnd tqrgets to the max_length and put them in
-        #one array
-        padded_inputs = np.array([np.append(
-            i, np.zeros([self.max_input_length-i.shape[0], i.shape[1]]), 0)
-                                  for i in added_inputs])
-        padded_targets = np.array([np.append(
-            t, np.zeros(self.max_target_length-t.shape[0]), 0)
-                                   for t in added_targets])
-
-        #transpose the inputs and targets so they fit in the placeholders
-        padded_inputs = padded_inputs.transpose([1, 0, 2])
-        padded_targets = padded_targets.transpose()
-
-        #feed in the batches one by one and accumulate the gradients and loss
-        for k in range(len(added_inputs)/self.numutterances_per_minibatch):
-            batch_inputs = padded_inputs[:, k*self.numutterances_per_minibatch:
-                                         (k+1)*self.numutterances_per_minibatch,
-                                         :]
-
-            batch_targets = padded_targets[
-                :, k*self.numutterances_per_minibatch:
-                (k+1)*self.numutterances_per_minibatch]
-
-            batch_input_seq_length = input_seq_length[
-                k*self.numutterances_per_minibatch:
-                (k+1)*self.numutterances_per_minibatch]
-
-            batch_output_seq_length = output_seq_length[
-                k*self.numutterances_per_minibatch:
-                (k+1)*self.numutterances_per_minibatch]
+        #pad the validation set the first time it is evaluated, the
+        #utterances are sorted by length so the minibatches need little padding
+        if inputs is not self.valid_inputs or targets is not self.valid_targets:
+            order = sorted(range(len(inputs)), key=lambda i: inputs[i].shape[0])
+            self.valid_minibatches = self.pad([inputs[i] for i in order],
+                                              [targets[i] for i in order])
+            self.valid_inputs = inputs
+            self.valid_targets = targets
 
-            #pylint: disable=E1101
-            self.update_valid_loss.run(
-                feed_dict={self.inputs:batch_inputs,
-                           self.targets:batch_targets[:, :, np.newaxis],
-                           self.input_seq_length:batch_input_seq_length,
-                           self.target_seq_length:batch_output_seq_length})
+        #feed in the minibatches one by one and accumulate the loss
+        self.feed_minibatches(self.valid_minibatches, self.update_valid_loss)
+
+        return self.collect_loss()
+
+    def collect_loss(self):
+        '''
+        get the accumulated validation loss and reset it
+
+        Returns:
+            the average validation loss
+        '''
 
         #get the loss
         loss = self.average_loss.eval()
@@ -440,6 +453,121 @@ class Trainer(object):
 
         return loss
 
+    def feed(self, inputs, targets, bucket_ops):
+        '''
+        feed a batch to the graph minibatch by minibatch, every minibatch is
+        padded to the smallest bucket it fits in
+
+        Args:
+            inputs: the inputs to the neural net, this should be a list
+                containing an NxF matrix for each utterance in the batch where
+                N is the number of frames in the utterance
+            targets: the targets for neural nnet, this should be
+                a list containing an N-dimensional vector for each utterance
+            bucket_ops: a list containing the operation that is run for every
+                bucket
+
+        Returns:
+            the number of frames and the number of padded frames that were fed
+        '''
+
+        return self.feed_minibatches(self.pad(inputs, targets), bucket_ops)
+
+    def pad(self, inputs, targets):
+        '''
+        pad a batch minibatch by minibatch, every minibatch is padded to the
+        smallest bucket it fits in
+
+        Args:
+            inputs: the inputs to the neural net, this should be a list
+                containing an NxF matrix for each utterance in the batch where
+                N is the number of frames in the utterance
+            targets: the targets for neural nnet, this should be
+                a list containing an N-dimensional vector for each utterance
+
+        Returns:
+            a list containing a pair for every minibatch with the index of the
+            bucket and the feed dict for the placeholders of the bucket
+        '''
+
+        minibatches = []
+
+        for k in range(0, len(inputs), self.numutterances_per_minibatch):
+            minibatch_inputs = inputs[k:k+self.numutterances_per_minibatch]
+            minibatch_targets = targets[k:k+self.numutterances_per_minibatch]
+
+            #get a list of sequence lengths, the minibatch is filled with
+            #empty sequences
+            input_seq_length = np.array(
+                [i.shape[0] for i in minibatch_inputs]
+                + (self.numutterances_per_minibatch
+                   - len(minibatch_inputs))*[0], dtype=np.int32)
+            output_seq_length = np.array(
+                [t.shape[0] for t in minibatch_targets]
+                + (self.numutterances_per_minibatch
+                   - len(minibatch_targets))*[0], dtype=np.int32)
+
+            #find the smallest bucket the minibatch fits in
+            bucket = bisect.bisect_left(self.buckets, max(input_seq_length))
+            if bucket == len(self.buckets):
+                raise Exception('an utterance is longer than the maximal '
+                                'input length')
+
+            #pad all the inputs and targets to the bucket length and put them
+            #in one array, in the layout of the placeholders
+            batch_inputs = np.zeros(
+                [self.buckets[bucket], self.numutterances_per_minibatch,
+                 minibatch_inputs[0].shape[1]], dtype=np.float32)
+            batch_targets = np.zeros(
+                [self.target_buckets[bucket], self.numutterances_per_minibatch,
+                 1], dtype=np.int32)
+            for i, (utt_inputs, utt_targets) in enumerate(
+                    zip(minibatch_inputs, minibatch_targets)):
+                batch_inputs[:utt_inputs.shape[0], i] = utt_inputs
+                batch_targets[:utt_targets.shape[0], i, 0] = utt_targets
+
+            minibatches.append(
+                (bucket, {self.inputs[bucket]:batch_inputs,
+                          self.targets[bucket]:batch_targets,
+                          self.input_seq_length[bucket]:input_seq_length,
+                          self.target_seq_length[bucket]:output_seq_length}))
+
+        return minibatches
+
+    def feed_minibatches(self, minibatches, bucket_ops):
+        '''
+        feed padded minibatches to the graph
+
+        Args:
+            minibatches: the padded minibatches as returned by pad
+            bucket_ops: a list containing the operation that is run for every
+                bucket
+
+        Returns:
+            the number of frames and the number of padded frames that were fed
+        '''
+
+        num_frames = 0
+        num_padded_frames = 0
+
+        for bucket, feed_dict in minibatches:
+            bucket_ops[bucket].run(feed_dict=feed_dict)
+
+            batch_inputs = feed_dict[self.inputs[bucket]]
+            num_frames += int(feed_dict[self.input_seq_length[bucket]].sum())
+            num_padded_frames += batch_inputs.shape[0]*batch_inputs.shape[1]
+
+        return num_frames, num_padded_frames
+
+    @property
+    def padding_efficiency(self):
+        '''the fraction of the frames fed for training that are not padding'''
+
+        if self.num_padded_frames == 0:
+            return 1.0
+
+        return float(self.num_frames)/self.num_padded_frames
+
     def halve_learning_rate(self):
         '''halve the learning rate'''
 
@@ -530,6 +658,152 @@ class CrossEnthropyTrainer(Trainer):
             return tf.reduce_sum(tf.nn.softmax_cross_entropy_with_logits(
                 nonseq_logits, nonseq_targets))
 
+class FrameTrainer(Trainer):
+    '''A trainer that minimises the cross-enthropy loss of independent frames,
+    it is fed [N, F] minibatches of frames and their targets (e.g. from a
+    FrameBatchDispenser), so no padding is needed. The classifier has to
+    process every time step independently (like the DNN)'''
+
+    def __init__(self, classifier, input_dim, init_learning_rate,
+                 learning_rate_decay, num_steps):
+        '''
+        FrameTrainer constructor, creates the training graph
+
+        Args:
+            classifier: the neural net classifier that will be trained
+            input_dim: the input dimension to the nnnetgraph
+            init_learning_rate: the initial learning rate
+            learning_rate_decay: the parameter for exponential learning rate
+                decay
+            num_steps: the total number of steps that will be taken
+        '''
+
+        #there is no padding
+        self.num_frames = 0
+        self.num_padded_frames = 0
+
+        #the validation set and the feed dict with its frames in contiguous
+        #arrays, which is only created the first time it is evaluated
+        self.valid_inputs = None
+        self.valid_targets = None
+        self.valid_feed_dict = None
+
+        #create the graph
+        self.graph = tf.Graph()
+
+        with self.graph.as_default():
+
+            #the inputs and targets of the frames in the minibatch
+            self.inputs = tf.placeholder(tf.float32, shape=[None, input_dim],
+                                         name='inputs')
+            self.targets = tf.placeholder(tf.int32, shape=[None],
+                                          name='targets')
+
+            #compute the training outputs of the nnetgraph, the minibatch is
+            #one time step of a batch of sequences without sequence lengths
+            trainlogits, _, self.modelsaver, self.control_ops = classifier(
+                [self.inputs], None, is_training=True, reuse=False,
+                scope='Classifier')
+            update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+
+            #compute the validation output of the nnetgraph
+            logits, _, _, _ = classifier([self.inputs], None,
+                                         is_training=False, reuse=True,
+                                         scope='Classifier')
+
+            with tf.name_scope('train'):
+                train_loss = self.compute_loss(self.targets, trainlogits[0],
+                                               None, None)
+
+            with tf.name_scope('valid'):
+                valid_loss = self.compute_loss(self.targets, logits[0], None,
+                                               None)
+
+            self.create_training_ops(
+                [train_loss], [valid_loss], [update_ops],
+                [tf.shape(self.targets)[0]], init_learning_rate,
+                learning_rate_decay, num_steps)
+
+        #specify that the graph can no longer be modified after this point
+        self.graph.finalize()
+
+        #start without visualisation
+        self.summarywriter = None
+
+    def compute_loss(self, targets, logits, logit_seq_length,
+                     target_seq_length):
+        '''
+        Compute the loss
+
+        Creates the operation to compute the cross-enthropy loss of the frames
+
+        Args:
+            targets: an N-dimensional tensor containing the targets of the
+                frames
+            logits: an NxO tensor containing the output logits of the frames
+            logit_seq_length: not used
+            target_seq_length: not used
+
+        Returns:
+            a scalar value containing the loss
+        '''
+
+        with tf.name_scope('cross_enthropy_loss'):
+
+            #one hot encode the targets
+            #pylint: disable=E1101
+            onehot_targets = tf.one_hot(targets, int(logits.get_shape()[1]))
+
+            #compute the cross-enthropy loss
+            return tf.reduce_sum(tf.nn.softmax_cross_entropy_with_logits(
+                logits, onehot_targets))
+
+    def update(self, inputs, targets):
+        '''
+        update the neural model with a minibatch of frames
+
+        Args:
+            inputs: an NxF numpy array containing the input frames
+            targets: an N-dimensional numpy array containing the targets
+
+        Returns:
+            the loss at this step
+        '''
+
+        self.update_gradients_op[0].run(
+            feed_dict={self.inputs:inputs, self.targets:targets})
+
+        self.num_frames += inputs.shape[0]
+        self.num_padded_frames += inputs.shape[0]
+
+        return self.apply_gradients()
+
+    def evaluate(self, inputs, targets):
+        '''
+        Evaluate the performance of the neural net
+
+        Args:
+            inputs: an NxF numpy array containing the input frames
+            targets: an N-dimensional numpy array containing the targets
+
+        Returns:
+            the loss of the frames
+        '''
+
+        if inputs is None or targets is None:
+            return None
+
+        if inputs is not self.valid_inputs or targets is not self.valid_targets:
+            self.valid_feed_dict = {
+                self.inputs:np.ascontiguousarray(inputs, dtype=np.float32),
+                self.targets:np.ascontiguousarray(targets, dtype=np.int32)}
+            self.valid_inputs = inputs
+            self.valid_targets = targets
+
+        self.update_valid_loss[0].run(feed_dict=self.valid_feed_dict)
+
+        return self.collect_loss()
+
 class CTCTrainer(Trainer):
     '''A trainer that minimises the CTC loss, the output sequences'''
 
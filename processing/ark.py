@@ -19,42 +19,98 @@ See the Apache 2 License for the specific language governing permissions and
 limitations under the License.
 '''
 
+import os
+import re
+import sys
 import struct
+import gzip
+import subprocess
+import tempfile
+from collections import OrderedDict
 import numpy as np
 
 np.set_printoptions(threshold=np.nan)
 np.set_printoptions(linewidth=np.nan)
 
+#the maximal size of a binary matrix header: binary marker, type token and
+#dimensions (and value range for compressed matrices)
+HEADER_SIZE = 22
+
+#the binary matrix types that can be read, the position of a type in this list
+#is the code that is stored in the archive index so only append to it. IV is a
+#Kaldi int32 vector (e.g. an alignment), which has no type token in the archive.
+#HM is a half precision matrix, this is not a Kaldi type so archives containing
+#it can only be read by this module
+MATRIX_TYPES = ['FM', 'DM', 'CM', 'CM2', 'CM3', 'IV', 'HM']
+
+#the numpy data type of the uncompressed matrix types
+DTYPES = {'FM': np.float32, 'DM': np.float64, 'HM': np.float16}
+
+#the bytes per value of the compressed matrix types
+COMPRESSED_SIZES = {'CM': 1, 'CM2': 2, 'CM3': 1}
+
+#the layout of an int32 vector element, Kaldi writes the size of every element
+#in bytes before its value
+IV_DTYPE = np.dtype([('size', 'i1'), ('value', '<i4')])
+
 class ArkReader(object):
     '''
     Class to read Kaldi ark format. Each time, it reads one line of the .scp
     file and reads in the corresponding features into a numpy matrix. It only
-    supports binary-formatted .ark files. Text and compressed .ark files are not
-    supported. The inspiration for this class came from pdnn toolkit (see
-    licence at the top of this file) (https://github.com/yajiemiao/pdnn)
+    supports binary-formatted .ark files, compressed matrices are decompressed.
+    Text .ark files are not supported. The archive files are kept open in a
+    pool of least recently used files, so call close() or use the reader as a
+    context manager when it is no longer needed. In memmap mode the returned
+    uncompressed matrices are read-only views into the archives, copy them if
+    they have to be modified. The inspiration for this class came from pdnn
+    toolkit (see licence at the top of this file)
+    (https://github.com/yajiemiao/pdnn)
     '''
 
-    def __init__(self, scp_path):
+    def __init__(self, scp_path, max_open_files=16, memmap=False,
+                 use_index=True):
         '''
         ArkReader constructor
 
         Args:
             scp_path: path to the .scp file
+            max_open_files: the maximum number of archive files that are kept
+                open at the same time, the least recently used file is closed
+                when the limit is reached
+            memmap: if True the archives are memory mapped and the reader
+                returns read-only views into the mapping instead of copies
+            use_index: if True the index of the archive entries is stored next
+                to the scp file and reused as long as the scp file does not
+                change
         '''
 
+        #pool of open archive files, ordered from least to most recently used
+        self.max_open_files = max(1, max_open_files)
+        self.open_files = OrderedDict()
+
+        #memory maps of the archives, only used if memmap is True
+        self.memmap = memmap
+        self.open_maps = {}
+
         self.scp_position = 0
-        fin = open(scp_path, "r")
-        self.utt_ids = []
-        self.scp_data = []
-        line = fin.readline()
-        while line != '' and line != None:
-            utt_id, path_pos = line.replace('\n', '').split(' ')
-            path, pos = path_pos.split(':')
-            self.utt_ids.append(utt_id)
-            self.scp_data.append((path, pos))
-            line = fin.readline()
 
-        fin.close()
+        #load the index of the archive entries or create it from the scp file
+        index = load_index(scp_path) if use_index else None
+        if index is None:
+            index = create_index(scp_path)
+            if use_index:
+                save_index(scp_path, index)
+
+        self.utt_ids = index['utt_ids'].tolist()
+        self.ark_paths = index['ark_paths'].tolist()
+        self.files = index['files']
+        self.offsets = index['offsets']
+        self.rows = index['rows']
+        self.cols = index['cols']
+        self.types = index['types']
+
+        #hash index from utterance ID to position in the scp file
+        self.utt_index = {utt_id:i for i, utt_id in enumerate(self.utt_ids)}
 
     def read_utt_data(self, index):
         '''
@@ -64,35 +120,79 @@ class ArkReader(object):
             index: index of the utterance that will be read
 
         Returns:
-            a numpy array containing the data from the utterance
+            a numpy array containing the data from the utterance (a vector for
+            int32 vectors). If the reader memory maps the archives and the
+            matrix is not compressed this is a read-only view into the mapped
+            archive, the caller has to copy it before modifying it
         '''
 
-        ark_read_buffer = open(self.scp_data[index][0], 'rb')
-        ark_read_buffer.seek(int(self.scp_data[index][1]), 0)
-        header = struct.unpack('<xcccc', ark_read_buffer.read(5))
-        if header[0] != "B":
-            print "Input .ark file is not binary"
-            exit(1)
-        if header[1] == "C":
-            print "Input .ark file is compressed"
-            exit(1)
-
-        _, rows = struct.unpack('<bi', ark_read_buffer.read(5))
-        _, cols = struct.unpack('<bi', ark_read_buffer.read(5))
+        path = self.ark_paths[self.files[index]]
+        pos = int(self.offsets[index])
+        matrix_type = MATRIX_TYPES[self.types[index]]
+        rows = int(self.rows[index])
+        cols = int(self.cols[index])
 
-        if header[1] == "F":
-            tmp_mat = np.frombuffer(ark_read_buffer.read(rows * cols * 4),
-                                    dtype=np.float32)
-        elif header[1] == "D":
-            tmp_mat = np.frombuffer(ark_read_buffer.read(rows * cols * 8),
-                                    dtype=np.float64)
+        if self.memmap:
+            return read_matrix(self.get_map(path), pos, matrix_type, rows,
+                               cols)
 
-        utt_mat = np.reshape(tmp_mat, (rows, cols))
+        ark_read_buffer = self.get_file(path)
+        ark_read_buffer.seek(pos, 0)
 
-        ark_read_buffer.close()
+        utt_mat = read_matrix(
+            ark_read_buffer.read(object_size(matrix_type, rows, cols)), 0,
+            matrix_type, rows, cols)
 
         return utt_mat
 
+    def get_file(self, path):
+        '''
+        get an open handle to an archive file from the pool
+
+        the file is opened if it is not in the pool yet, if the pool is full the
+        least recently used file is closed
+
+        Args:
+            path: path to the .ark file
+
+        Returns:
+            a file object opened for binary reading
+        '''
+
+        if path in self.open_files:
+            #mark the file as most recently used
+            ark_file = self.open_files.pop(path)
+        else:
+            #close the least recently used file if the pool is full
+            if len(self.open_files) >= self.max_open_files:
+                _, lru_file = self.open_files.popitem(last=False)
+                lru_file.close()
+
+            ark_file = open(path, 'rb')
+
+        self.open_files[path] = ark_file
+
+        return ark_file
+
+    def get_map(self, path):
+        '''
+        get a read-only memory map of an archive file
+
+        every archive is mapped only once, the mapping is released when the
+        reader is closed and no views into the archive are left
+
+        Args:
+            path: path to the .ark file
+
+        Returns:
+            a read-only numpy memmap containing the bytes of the archive
+        '''
+
+        if path not in self.open_maps:
+            self.open_maps[path] = np.memmap(path, dtype=np.uint8, mode='r')
+
+        return self.open_maps[path]
+
     def read_next_utt(self):
         '''
         read the next utterance in the scp file
@@ -102,11 +202,24 @@ class ArkReader(object):
             bool that is true if the reader looped back to the beginning
         '''
 
-        if len(self.scp_data) == 0:
+        if len(self.utt_ids) == 0:
             return None, None, True
 
+        index, looped = self.next_index()
+
+        return self.utt_ids[index], self.read_utt_data(index), looped
+
+    def next_index(self):
+        '''
+        move to the next utterance in the scp file without reading it
+
+        Returns:
+            the index of the utterance in the scp file and a bool that is true
+            if the reader looped back to the beginning
+        '''
+
         #if at end of file loop around
-        if self.scp_position >= len(self.scp_data):
+        if self.scp_position >= len(self.utt_ids):
             looped = True
             self.scp_position = 0
         else:
@@ -114,8 +227,7 @@ class ArkReader(object):
 
         self.scp_position += 1
 
-        return (self.utt_ids[self.scp_position-1],
-                self.read_utt_data(self.scp_position-1), looped)
+        return self.scp_position - 1, looped
 
     def read_next_scp(self):
         '''
@@ -126,7 +238,7 @@ class ArkReader(object):
         '''
 
         #if at end of file loop around
-        if self.scp_position >= len(self.scp_data):
+        if self.scp_position >= len(self.utt_ids):
             self.scp_position = 0
 
         self.scp_position += 1
@@ -142,7 +254,7 @@ class ArkReader(object):
         '''
 
         if self.scp_position < 0: #if at beginning of file loop around
-            self.scp_position = len(self.scp_data) - 1
+            self.scp_position = len(self.utt_ids) - 1
 
         self.scp_position -= 1
 
@@ -156,24 +268,791 @@ class ArkReader(object):
             the utterance data corresponding to the ID
         '''
 
-        return self.read_utt_data(self.utt_ids.index(utt_id))
+        return self.read_utt_data(self.utt_index[utt_id])
+
+    def read_many(self, utts, packed=False, max_gap=65536):
+        '''
+        read the data of many utterances with as few reads as possible
+
+        The requests are sorted by archive and position and requests that are
+        close to each other in an archive are read with one sequential read.
+        The data is returned in the requested order.
+
+        Args:
+            utts: a list of utterance IDs or indices in the scp file
+            packed: if True all the matrices are packed into one contiguous
+                array
+            max_gap: the maximal number of bytes between two requests that are
+                still read together
+
+        Returns:
+            if packed is False a list of numpy arrays in the requested order,
+            otherwise a pair containing a numpy array with all matrices
+            concatenated along the first axis and a numpy array with the N+1
+            row offsets of the matrices in this array
+        '''
+
+        indices = np.array([self.utt_index[utt] if isinstance(utt, basestring)
+                            else utt for utt in utts], dtype=np.int64)
+        files = self.files[indices]
+        begins = self.offsets[indices]
+        ends = begins + np.array(
+            [object_size(MATRIX_TYPES[self.types[index]],
+                         int(self.rows[index]), int(self.cols[index]))
+             for index in indices], dtype=np.int64)
+
+        #sort the requests by archive and position
+        order = np.lexsort((begins, files))
+
+        utt_mats = [None]*len(indices)
+        start = 0
+        while start < len(order):
+            #find the requests that can be read together with the first one
+            first = order[start]
+            block_end = ends[first]
+            stop = start + 1
+            while (stop < len(order) and files[order[stop]] == files[first]
+                   and begins[order[stop]] - block_end <= max_gap):
+                block_end = max(block_end, ends[order[stop]])
+                stop += 1
+
+            path = self.ark_paths[files[first]]
+            if self.memmap:
+                block = self.get_map(path)
+                block_begin = 0
+            else:
+                ark_read_buffer = self.get_file(path)
+                ark_read_buffer.seek(int(begins[first]), 0)
+                block = ark_read_buffer.read(int(block_end - begins[first]))
+                block_begin = begins[first]
+
+            for request in order[start:stop]:
+                index = indices[request]
+                utt_mats[request] = read_matrix(
+                    block, int(begins[request] - block_begin),
+                    MATRIX_TYPES[self.types[index]], int(self.rows[index]),
+                    int(self.cols[index]))
+
+            start = stop
+
+        if not packed:
+            return utt_mats
+
+        #copy all matrices in one preallocated array
+        row_offsets = np.concatenate(
+            [[0], np.cumsum([utt_mat.shape[0] for utt_mat in utt_mats])])
+        packed_mats = np.empty(
+            (row_offsets[-1],) + (utt_mats[0].shape[1:] if utt_mats else ()),
+            dtype=np.result_type(*utt_mats) if utt_mats else np.float32)
+        for i, utt_mat in enumerate(utt_mats):
+            packed_mats[row_offsets[i]:row_offsets[i+1]] = utt_mat
+
+        return packed_mats, row_offsets
+
+    def read_next_utts(self, num_utt):
+        '''
+        read the next utterances in the scp file with one bulk read
+
+        Args:
+            num_utt: the number of utterances that will be read
+
+        Returns:
+            a list of utterance IDs, a list with the data of the utterances
+            and a list of bools that are true if the reader looped back to the
+            beginning before reading the utterance
+        '''
+
+        if len(self.utt_ids) == 0 or num_utt == 0:
+            return [None]*num_utt, [None]*num_utt, [True]*num_utt
+
+        indices, looped = zip(*[self.next_index() for _ in range(num_utt)])
+
+        return ([self.utt_ids[index] for index in indices],
+                self.read_many(indices), list(looped))
 
     def split(self):
         '''Split of the data that was read so far'''
 
-        self.scp_data = self.scp_data[self.scp_position:-1]
-        self.utt_ids = self.utt_ids[self.scp_position:-1]
+        self.utt_ids = self.utt_ids[self.scp_position:]
+        self.files = self.files[self.scp_position:]
+        self.offsets = self.offsets[self.scp_position:]
+        self.rows = self.rows[self.scp_position:]
+        self.cols = self.cols[self.scp_position:]
+        self.types = self.types[self.scp_position:]
+        self.utt_index = {utt_id:i for i, utt_id in enumerate(self.utt_ids)}
+        self.scp_position = 0
+
+    def reorder(self, order):
+        '''
+        change the order of the utterances, the reader starts at the beginning
+        of the new order
+
+        Args:
+            order: the indices of the utterances in the new order, utterances
+                that are not in the order are removed from the reader
+        '''
+
+        order = np.asarray(order, dtype=np.int64)
+
+        self.utt_ids = [self.utt_ids[index] for index in order]
+        self.files = self.files[order]
+        self.offsets = self.offsets[order]
+        self.rows = self.rows[order]
+        self.cols = self.cols[order]
+        self.types = self.types[order]
+        self.utt_index = {utt_id:i for i, utt_id in enumerate(self.utt_ids)}
+        self.scp_position = 0
+
+    @property
+    def lengths(self):
+        '''the number of rows of every utterance'''
+
+        return self.rows
+
+    def close(self):
+        '''close all the archive files that are kept open by the reader'''
+
+        for ark_file in self.open_files.values():
+            ark_file.close()
+
+        self.open_files.clear()
+
+        #views that were handed out keep their own reference to the mapping
+        self.open_maps.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class ArkStreamReader(object):
+    '''
+    Class to read a binary Kaldi archive sequentially from a stream, e.g. stdin,
+    the output of a Kaldi pipeline or a gzipped archive. No scp file is needed
+    and only the utterance that is being read is kept in memory, so the stream
+    can not be searched or rewound. Iterating over the reader yields
+    (utterance ID, data) pairs.
+    '''
+
+    def __init__(self, rspecifier, chunk_size=65536):
+        '''
+        ArkStreamReader constructor
+
+        Args:
+            rspecifier: a file object opened for binary reading or a string
+                describing the archive: ark:- for stdin, ark:command | for the
+                output of a command or the path to an archive, which is
+                decompressed if it ends in .gz
+            chunk_size: the number of bytes that are read from the stream at a
+                time
+        '''
+
+        self.process = None
+        if isinstance(rspecifier, basestring):
+            self.stream = self.open_stream(rspecifier)
+        else:
+            self.stream = rspecifier
+
+        self.chunk_size = chunk_size
+
+        #the data that has been read from the stream but not parsed yet
+        self.buffer = ''
+        self.position = 0
+
+    def open_stream(self, rspecifier):
+        '''
+        open the stream described by an rspecifier
+
+        Args:
+            rspecifier: the archive description, see the constructor
+
+        Returns:
+            a file object opened for binary reading
+        '''
+
+        #remove the ark type and its options (e.g. ark,s,cs:)
+        if is_rspecifier(rspecifier):
+            rspecifier = rspecifier.split(':', 1)[1]
+
+        rspecifier = rspecifier.strip()
+
+        if rspecifier == '-':
+            return sys.stdin
+
+        if rspecifier.endswith('|'):
+            self.process = subprocess.Popen(rspecifier[:-1], shell=True,
+                                            stdout=subprocess.PIPE)
+            return self.process.stdout
+
+        if rspecifier.endswith('.gz'):
+            return gzip.open(rspecifier, 'rb')
+
+        return open(rspecifier, 'rb')
+
+    def fill(self, size):
+        '''
+        make sure the buffer contains at least size unparsed bytes, unless the
+        stream ends first
+
+        Args:
+            size: the required number of bytes
+
+        Returns:
+            True if the buffer contains enough bytes
+        '''
+
+        chunks = [self.buffer[self.position:]]
+        available = len(chunks[0])
+
+        while available < size:
+            data = self.stream.read(max(self.chunk_size, size - available))
+            if not data:
+                break
+            chunks.append(data)
+            available += len(data)
+
+        self.buffer = ''.join(chunks)
+        self.position = 0
+
+        return available >= size
+
+    def read_next_utt(self):
+        '''
+        read the next utterance in the stream
+
+        Returns:
+            the utterance ID of the utterance that was read, the utterance data,
+            bool that is true if the end of the stream was reached, in which
+            case the ID and data are None
+        '''
+
+        #the key is terminated by a space
+        end = self.buffer.find(' ', self.position)
+        while end == -1:
+            searched = len(self.buffer) - self.position
+            if not self.fill(searched + 1):
+                return None, None, True
+            end = self.buffer.find(' ', self.position + searched)
+
+        utt_id = self.buffer[self.position:end].lstrip()
+        self.position = end + 1
+
+        #parse the header to know the size of the object, the header of the
+        #smallest object can be shorter than HEADER_SIZE
+        self.fill(HEADER_SIZE)
+        matrix_type, rows, cols = parse_header(self.buffer, self.position)
+        size = object_size(matrix_type, rows, cols)
+        if not self.fill(size):
+            raise IOError('unexpected end of the archive in %s' % utt_id)
+
+        #copy the object out of the buffer so the buffer can be released
+        utt_mat = read_matrix(self.buffer[self.position:self.position + size],
+                              0, matrix_type, rows, cols)
+        self.position += size
+
+        return utt_id, utt_mat, False
+
+    def read_next_utts(self, num_utt):
+        '''
+        read the next utterances in the stream
+
+        Args:
+            num_utt: the number of utterances that will be read
+
+        Returns:
+            a list of utterance IDs, a list with the data of the utterances and
+            a list of bools that are true if the end of the stream was reached
+        '''
+
+        utts = [self.read_next_utt() for _ in range(num_utt)]
+
+        return [list(values) for values in zip(*utts)]
+
+    def __iter__(self):
+        '''
+        iterate over the utterances in the stream
+
+        Yields:
+            the utterance ID and the utterance data
+        '''
+
+        while True:
+            utt_id, utt_mat, ended = self.read_next_utt()
+            if ended:
+                return
+            yield utt_id, utt_mat
+
+    def close(self):
+        '''close the stream and wait for the command that produces it'''
+
+        if self.stream is not sys.stdin:
+            self.stream.close()
+
+        if self.process is not None:
+            self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def parse_header(buf, pos=0):
+    '''
+    parse the header of a binary matrix in an archive
+
+    Args:
+        buf: a buffer containing the header
+        pos: the position of the header in the buffer
+
+    Returns:
+        the matrix type (one of MATRIX_TYPES), the number of rows and the
+        number of columns of the matrix
+    '''
+
+    binary, token = struct.unpack_from('<xc4s', buf, pos)
+    if binary != "B":
+        print "Input .ark file is not binary"
+        exit(1)
+
+    #int32 vectors start with the integer size instead of a type token
+    if token[0] == chr(4):
+        rows, = struct.unpack_from('<i', buf, pos + 3)
+        return 'IV', rows, 1
+
+    matrix_type = token.split(' ')[0]
+    if matrix_type not in MATRIX_TYPES:
+        print "Input .ark file contains an unsupported object"
+        exit(1)
+
+    if matrix_type in DTYPES:
+        _, rows, _, cols = struct.unpack_from('<bibi', buf, pos + 5)
+    else:
+        #compressed matrices have a global header with the value range
+        _, _, rows, cols = struct.unpack_from(
+            '<ffii', buf, pos + len(matrix_type) + 3)
+
+    return matrix_type, rows, cols
+
+def header_size(matrix_type):
+    '''
+    the size of the header of a binary matrix
+
+    Args:
+        matrix_type: the matrix type (one of MATRIX_TYPES)
+
+    Returns:
+        the header size in bytes
+    '''
+
+    if matrix_type == 'IV':
+        return 7
+    elif matrix_type in DTYPES:
+        return len(matrix_type) + 13
+    else:
+        return len(matrix_type) + 19
+
+def object_size(matrix_type, rows, cols):
+    '''
+    the size of a binary matrix in an archive
+
+    Args:
+        matrix_type: the matrix type (one of MATRIX_TYPES)
+        rows: the number of rows of the matrix
+        cols: the number of columns of the matrix
+
+    Returns:
+        the size of the header and the data in bytes
+    '''
+
+    if matrix_type == 'IV':
+        #every element is preceded by its size in bytes (always 4)
+        data_size = rows*5
+    elif matrix_type in DTYPES:
+        data_size = rows*cols*np.dtype(DTYPES[matrix_type]).itemsize
+    elif matrix_type == 'CM':
+        #the compressed data is preceded by 4 uint16 percentiles per column
+        data_size = cols*8 + rows*cols
+    else:
+        data_size = rows*cols*COMPRESSED_SIZES[matrix_type]
+
+    return header_size(matrix_type) + data_size
+
+def read_matrix(buf, pos, matrix_type, rows, cols):
+    '''
+    read a binary matrix from a buffer
+
+    Args:
+        buf: a buffer containing the matrix
+        pos: the position of the matrix header in the buffer
+        matrix_type: the matrix type (one of MATRIX_TYPES)
+        rows: the number of rows of the matrix
+        cols: the number of columns of the matrix
+
+    Returns:
+        a numpy array containing the matrix (or a vector for int32 vectors),
+        uncompressed matrices and vectors are views into the buffer
+    '''
+
+    if matrix_type == 'IV':
+        return np.frombuffer(buf, dtype=IV_DTYPE, count=rows,
+                             offset=pos + header_size(matrix_type))['value']
+
+    if matrix_type not in DTYPES:
+        return decompress(buf, pos, matrix_type)
+
+    tmp_mat = np.frombuffer(buf, dtype=DTYPES[matrix_type], count=rows*cols,
+                            offset=pos + header_size(matrix_type))
+
+    return np.reshape(tmp_mat, (rows, cols))
+
+def decompress(buf, pos, matrix_type):
+    '''
+    decode a Kaldi compressed matrix
+
+    Args:
+        buf: a buffer containing the compressed matrix
+        pos: the position of the matrix header in the buffer
+        matrix_type: the compressed matrix type (CM, CM2 or CM3)
+
+    Returns:
+        a float32 numpy array containing the decompressed matrix
+    '''
+
+    min_value, value_range, rows, cols = struct.unpack_from(
+        '<ffii', buf, pos + len(matrix_type) + 3)
+    pos += header_size(matrix_type)
+
+    min_value = np.float32(min_value)
+    value_range = np.float32(value_range)
+
+    if matrix_type == 'CM2':
+        #two bytes per value, linearly quantized over the range
+        data = np.frombuffer(buf, dtype=np.uint16, count=rows*cols,
+                             offset=pos)
+        utt_mat = (min_value + value_range*np.float32(1.0/65535)
+                   *data.astype(np.float32))
+
+        return np.reshape(utt_mat, (rows, cols))
+
+    if matrix_type == 'CM3':
+        #one byte per value, linearly quantized over the range
+        data = np.frombuffer(buf, dtype=np.uint8, count=rows*cols, offset=pos)
+        utt_mat = (min_value + value_range*np.float32(1.0/255)
+                   *data.astype(np.float32))
+
+        return np.reshape(utt_mat, (rows, cols))
+
+    #CM stores the 0th, 25th, 75th and 100th percentile of every column
+    percentiles = np.frombuffer(buf, dtype=np.uint16, count=4*cols,
+                                offset=pos)
+    percentiles = (min_value + value_range*np.float32(1.0/65535)
+                   *percentiles.astype(np.float32)).reshape(cols, 4, 1)
+    p0, p25, p75, p100 = (percentiles[:, 0], percentiles[:, 1],
+                          percentiles[:, 2], percentiles[:, 3])
+
+    #create a lookup table with the value of all 256 byte values per column,
+    #the bytes are linearly mapped in the inter-percentile ranges
+    values = np.arange(256, dtype=np.float32)
+    table = np.where(
+        values <= 64, p0 + (p25 - p0)*values*np.float32(1.0/64),
+        np.where(values <= 192,
+                 p25 + (p75 - p25)*(values - 64)*np.float32(1.0/128),
+                 p75 + (p100 - p75)*(values - 192)*np.float32(1.0/63)))
+
+    #the data is stored column by column
+    data = np.frombuffer(buf, dtype=np.uint8, count=rows*cols,
+                         offset=pos + 8*cols).reshape(cols, rows)
+    utt_mat = table.ravel()[data + 256*np.arange(cols)[:, np.newaxis]]
+
+    return np.ascontiguousarray(utt_mat.T, dtype=np.float32)
+
+def create_index(scp_path):
+    '''
+    create the index of the entries in an scp file by reading the matrix
+    headers in the archives
+
+    Args:
+        scp_path: path to the .scp file
+
+    Returns:
+        a dictionary containing the index arrays:
+            - utt_ids: the utterance IDs in scp order
+            - ark_paths: the paths of the archive files
+            - files: the position of the archive of every entry in ark_paths
+            - offsets: the position of every entry in its archive
+            - rows: the number of rows of every entry
+            - cols: the number of columns of every entry
+            - types: the matrix type code of every entry
+    '''
+
+    utt_ids = []
+    ark_paths = []
+    files = []
+    offsets = []
+    path_index = {}
+
+    with open(scp_path, 'r') as fid:
+        for line in fid:
+            utt_id, path_pos = line.replace('\n', '').split(' ')
+            path, pos = path_pos.rsplit(':', 1)
+            if path not in path_index:
+                path_index[path] = len(ark_paths)
+                ark_paths.append(path)
+            utt_ids.append(utt_id)
+            files.append(path_index[path])
+            offsets.append(int(pos))
+
+    files = np.array(files, dtype=np.int32)
+    offsets = np.array(offsets, dtype=np.int64)
+    rows = np.zeros(len(utt_ids), dtype=np.int32)
+    cols = np.zeros(len(utt_ids), dtype=np.int32)
+    types = np.zeros(len(utt_ids), dtype=np.uint8)
+
+    #read the headers archive by archive in the order they appear on disk
+    for file_index, path in enumerate(ark_paths):
+        entries = np.flatnonzero(files == file_index)
+        entries = entries[np.argsort(offsets[entries], kind='mergesort')]
+        with open(path, 'rb') as ark_file:
+            for entry in entries:
+                ark_file.seek(offsets[entry], 0)
+                matrix_type, rows[entry], cols[entry] = parse_header(
+                    ark_file.read(HEADER_SIZE))
+                types[entry] = MATRIX_TYPES.index(matrix_type)
+
+    return {'utt_ids': np.array(utt_ids), 'ark_paths': np.array(ark_paths),
+            'files': files, 'offsets': offsets, 'rows': rows, 'cols': cols,
+            'types': types}
+
+def is_rspecifier(specifier):
+    '''
+    check if a string is an archive rspecifier (ark: or ark with options, e.g.
+    ark,s,cs:) and not a path that happens to start with ark
+
+    Args:
+        specifier: the string that is checked
+
+    Returns:
+        True if the string is an archive rspecifier
+    '''
+
+    return re.match(r'ark(,[^:/]*)?:', specifier) is not None
+
+def index_path(scp_path):
+    '''
+    the path of the index file that belongs to an scp file
+
+    Args:
+        scp_path: path to the .scp file
+
+    Returns:
+        the path to the index file
+    '''
+
+    return scp_path + '.idx'
+
+def load_index(scp_path):
+    '''
+    load the stored index of an scp file
+
+    Args:
+        scp_path: path to the .scp file
+
+    Returns:
+        the index as created by create_index or None if there is no index or
+        if the scp file has changed since the index was stored
+    '''
+
+    if not os.path.isfile(index_path(scp_path)):
+        return None
+
+    scp_stat = os.stat(scp_path)
+
+    #an index that can not be read (e.g. a truncated file) is rebuilt
+    try:
+        with open(index_path(scp_path), 'rb') as fid:
+            stored = np.load(fid)
+            index = {key: stored[key] for key in stored.files}
+    except Exception: #pylint: disable=W0703
+        return None
+
+    #only reuse the index if the scp file is unchanged
+    if (index.get('scp_mtime') != scp_stat.st_mtime
+            or index.get('scp_size') != scp_stat.st_size):
+        return None
+
+    return index
+
+def save_index(scp_path, index):
+    '''
+    store the index of an scp file next to the scp file, nothing is stored if
+    the directory is not writable
+
+    Args:
+        scp_path: path to the .scp file
+        index: the index as created by create_index
+    '''
+
+    scp_stat = os.stat(scp_path)
+    tmp_path = None
+
+    try:
+        #write to a temporary file first so a reader never sees a partial
+        #index, every process uses its own temporary file so processes that
+        #store the index at the same time don't write to the same file
+        handle, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(scp_path)),
+            prefix=os.path.basename(index_path(scp_path)) + '.',
+            suffix='.tmp')
+        with os.fdopen(handle, 'wb') as fid:
+            np.savez(fid, scp_mtime=scp_stat.st_mtime,
+                     scp_size=scp_stat.st_size, **index)
+        os.rename(tmp_path, index_path(scp_path))
+    except (IOError, OSError):
+        print 'WARNING could not store the index of %s' % scp_path
+        if tmp_path is not None and os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+def compress(utt_mat, matrix_type):
+    '''
+    compress a matrix with the Kaldi matrix compression
+
+    Args:
+        utt_mat: a numpy array containing the matrix
+        matrix_type: the compressed matrix type, CM (one byte per value with
+            per column percentiles, suited for features) or CM2 (two bytes per
+            value)
+
+    Returns:
+        a string containing the global header and the compressed data
+    '''
+
+    utt_mat = np.asarray(utt_mat, dtype=np.float32)
+    rows, cols = utt_mat.shape
+
+    #empty matrices only have an empty global header
+    if utt_mat.size == 0:
+        return struct.pack('<ffii', 0, 0, 0, 0)
+
+    #the global header contains the value range of the matrix
+    min_value = utt_mat.min()
+    max_value = utt_mat.max()
+    if max_value == min_value:
+        max_value = min_value + (1 + abs(min_value))
+    value_range = np.float32(max_value - min_value)
+    header = struct.pack('<ffii', min_value, value_range, rows, cols)
+
+    if matrix_type == 'CM2':
+        return header + float_to_uint16(utt_mat, min_value,
+                                        value_range).tostring()
+
+    if matrix_type != 'CM':
+        raise Exception('unsupported compression %s' % matrix_type)
+
+    #compute the 0th, 25th, 75th and 100th percentile of every column, they
+    #must be strictly increasing
+    sorted_mat = np.sort(utt_mat, 0)
+    if rows >= 5:
+        positions = [0, rows//4, 3*(rows//4), rows - 1]
+    else:
+        positions = range(rows)
+    percentiles = np.zeros([4, cols], dtype=np.int32)
+    for i, limit in enumerate([65532, 65533, 65534, 65535]):
+        if i < len(positions):
+            percentiles[i] = float_to_uint16(sorted_mat[positions[i]],
+                                             min_value, value_range)
+            if i > 0:
+                percentiles[i] = np.maximum(percentiles[i],
+                                            percentiles[i-1] + 1)
+        else:
+            percentiles[i] = percentiles[i-1] + 1
+        percentiles[i] = np.minimum(percentiles[i], limit)
+
+    col_headers = percentiles.T.astype(np.uint16)
+    p0, p25, p75, p100 = (min_value + value_range*np.float32(1.0/65535)
+                          *percentiles.astype(np.float32))
+
+    #map the values linearly in the inter-percentile ranges to 0-64, 64-192
+    #and 192-255
+    lower = np.clip(np.floor((utt_mat - p0)/(p25 - p0)*64 + 0.5), 0, 64)
+    middle = np.clip(64 + np.floor((utt_mat - p25)/(p75 - p25)*128 + 0.5),
+                     64, 192)
+    upper = np.clip(192 + np.floor((utt_mat - p75)/(p100 - p75)*63 + 0.5),
+                    192, 255)
+    data = np.where(utt_mat < p25, lower,
+                    np.where(utt_mat < p75, middle, upper)).astype(np.uint8)
+
+    #the data is stored column by column
+    return header + col_headers.tostring() + data.T.tostring()
+
+def encode(utt_mat, compression=None):
+    '''
+    encode a matrix as a binary archive object
+
+    Args:
+        utt_mat: a numpy array containing the matrix, a one dimensional integer
+            array is encoded as an int32 vector
+        compression: the matrix type, CM, CM2 or HM, if None the matrix is
+            encoded as a float matrix
+
+    Returns:
+        a string containing the binary header and a string containing the data
+    '''
+
+    utt_mat = np.asarray(utt_mat)
+
+    if utt_mat.ndim == 1 and utt_mat.dtype.kind in 'iu':
+        data = np.empty(utt_mat.size, dtype=IV_DTYPE)
+        data['size'] = 4
+        data['value'] = utt_mat
+        return (('\0B' + struct.pack('<bi', 4, utt_mat.size)),
+                data.tostring())
+
+    if compression in [None, 'HM']:
+        matrix_type = compression or 'FM'
+        utt_mat = np.asarray(utt_mat, dtype=DTYPES[matrix_type])
+        rows, cols = utt_mat.shape
+        return ('\0B%s ' % matrix_type + struct.pack('<bibi', 4, rows, 4, cols),
+                np.ascontiguousarray(utt_mat).tostring())
+
+    return '\0B%s ' % compression, compress(utt_mat, compression)
+
+def float_to_uint16(values, min_value, value_range):
+    '''
+    quantize values linearly in the global range of a compressed matrix
+
+    Args:
+        values: a numpy array containing the values
+        min_value: the minimal value of the range
+        value_range: the size of the range
+
+    Returns:
+        a uint16 numpy array containing the quantized values
+    '''
+
+    fraction = np.clip((values - min_value)/value_range, 0, 1)
+
+    return np.floor(fraction*65535 + np.float32(0.499)).astype(np.uint16)
 
 class ArkWriter(object):
     '''
     Class to write numpy matrices into Kaldi .ark file and create the
-    corresponding .scp file. It only supports binary-formatted .ark files. Text
-    and compressed .ark files are not supported. The inspiration for this class
-    came from pdnn toolkit (see licence at the top of this file)
+    corresponding .scp file. It only supports binary-formatted .ark files,
+    which can optionally be compressed. One dimensional integer arrays are
+    written as Kaldi int32 vectors. Text .ark files are not supported. The
+    archive files are kept open and the data is buffered in memory and written
+    in large blocks, so the writer must be closed (or used as a context
+    manager) to write the last data. In sharded mode the utterances are
+    distributed over N archives (name.1.ark ... name.N.ark) with an scp file
+    per shard and a merged scp file with all utterances. The inspiration for
+    this class came from pdnn toolkit (see licence at the top of this file)
     (https://github.com/yajiemiao/pdnn)
     '''
 
-    def __init__(self, scp_path, default_ark):
+    def __init__(self, scp_path, default_ark, compression=None,
+                 buffer_size=4194304, fsync=False, num_shards=1,
+                 shard_by='roundrobin', utt2spk=None):
         '''
         Arkwriter constructor
 
@@ -181,36 +1060,184 @@ class ArkWriter(object):
             scp_path: path to the .scp file that will be written
             default_ark: the name of the default ark file (used when not
                 specified)
+            compression: the Kaldi compressed matrix type that is used to
+                write the matrices, CM or CM2, or HM to write the matrices as
+                half precision floats (which Kaldi can not read), if None the
+                matrices are written uncompressed
+            buffer_size: the number of bytes that are buffered before they are
+                written to the archives
+            fsync: if True the files are synced to disk every time the buffer
+                is written
+            num_shards: the number of shards the utterances are distributed
+                over, if 1 no sharding is done
+            shard_by: how the utterances are assigned to the shards, options
+                are roundrobin, speaker (all utterances of a speaker go to the
+                same shard) or a dictionary mapping every utterance ID to a
+                shard number (1 to num_shards)
+            utt2spk: a dictionary mapping utterance IDs to speaker IDs, required
+                if the utterances are sharded by speaker
         '''
 
+        if compression not in [None, 'CM', 'CM2', 'HM']:
+            raise Exception('unsupported compression %s' % compression)
+
+        if shard_by == 'speaker' and utt2spk is None:
+            raise Exception('sharding by speaker requires utt2spk')
+
         self.scp_path = scp_path
         self.scp_file_write = open(self.scp_path, 'w')
         self.default_ark = default_ark
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+
+        #the open archive files and the position where the next utterance in
+        #each archive will be written
+        self.ark_files = {}
+        self.ark_positions = {}
+
+        #the buffered archive data per archive and the buffered scp lines
+        self.ark_buffers = {}
+        self.scp_buffer = []
+        self.buffered_bytes = 0
+
+        #the scp files of the shards and their buffered scp lines
+        self.num_shards = num_shards
+        self.shard_by = shard_by
+        self.utt2spk = utt2spk
+        if num_shards > 1:
+            self.shard_scp_files = [open(shard_path(scp_path, shard), 'w')
+                                    for shard in range(1, num_shards + 1)]
+        else:
+            self.shard_scp_files = []
+        self.shard_scp_buffers = [[] for _ in self.shard_scp_files]
+
+        #the shards of the speakers and the number of utterances written
+        self.spk_shards = {}
+        self.num_written = 0
 
-    def write_next_utt(self, utt_id, utt_mat, ark_path=None):
+    def write_next_utt(self, utt_id, utt_mat, ark_path=None, shard=None):
         '''
         read an utterance to the archive
 
         Args:
-            ark_path: path to the .ark file that will be used for writing
+            ark_path: path to the .ark file that will be used for writing, in
+                sharded mode the shard number is added to the name
             utt_id: the utterance ID
-            utt_mat: a numpy array containing the utterance data
+            utt_mat: a numpy array containing the utterance data, a one
+                dimensional integer array is written as an int32 vector
+            shard: the shard number (1 to num_shards) the utterance is written
+                to, if None the shard is chosen with the sharding policy
         '''
 
         ark = ark_path or self.default_ark
-        ark_file_write = open(ark, 'ab')
-        utt_mat = np.asarray(utt_mat, dtype=np.float32)
-        rows, cols = utt_mat.shape
-        ark_file_write.write(struct.pack('<%ds'%(len(utt_id)), utt_id))
-        pos = ark_file_write.tell()
-        ark_file_write.write(struct.pack('<xcccc', 'B', 'F', 'M', ' '))
-        ark_file_write.write(struct.pack('<bi', 4, rows))
-        ark_file_write.write(struct.pack('<bi', 4, cols))
-        ark_file_write.write(utt_mat)
-        self.scp_file_write.write('%s %s:%s\n' % (utt_id, ark, pos))
-        ark_file_write.close()
+
+        if self.num_shards > 1:
+            if shard is None:
+                shard = self.choose_shard(utt_id)
+            ark = shard_path(ark, shard)
+
+        if ark not in self.ark_files:
+            #the archive is opened unbuffered, the buffering is done here
+            self.ark_files[ark] = open(ark, 'ab', 0)
+            self.ark_positions[ark] = os.path.getsize(ark)
+            self.ark_buffers[ark] = []
+
+        header, data = encode(utt_mat, self.compression)
+
+        key = '%s ' % utt_id
+        pos = self.ark_positions[ark] + len(key)
+        self.ark_buffers[ark].extend([key, header, data])
+        self.ark_positions[ark] = pos + len(header) + len(data)
+        self.scp_buffer.append('%s %s:%s\n' % (utt_id, ark, pos))
+        if self.num_shards > 1:
+            self.shard_scp_buffers[shard-1].append(self.scp_buffer[-1])
+        self.buffered_bytes += len(key) + len(header) + len(data)
+        self.num_written += 1
+
+        if self.buffered_bytes >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        '''write all the buffered data to the files'''
+
+        #write the archives before the scp file so the scp file never points to
+        #data that has not been written
+        for ark, ark_buffer in self.ark_buffers.items():
+            if ark_buffer:
+                self.ark_files[ark].write(''.join(ark_buffer))
+                del ark_buffer[:]
+                if self.fsync:
+                    os.fsync(self.ark_files[ark].fileno())
+
+        for scp_file, scp_buffer in zip(
+                [self.scp_file_write] + self.shard_scp_files,
+                [self.scp_buffer] + self.shard_scp_buffers):
+            scp_file.write(''.join(scp_buffer))
+            scp_file.flush()
+            if self.fsync:
+                os.fsync(scp_file.fileno())
+            del scp_buffer[:]
+        self.buffered_bytes = 0
 
     def close(self):
         '''close the ark writer'''
 
+        self.flush()
+
+        for ark_file in self.ark_files.values():
+            ark_file.close()
+
+        self.ark_files.clear()
+        self.ark_positions.clear()
+        self.ark_buffers.clear()
         self.scp_file_write.close()
+
+        for scp_file in self.shard_scp_files:
+            scp_file.close()
+
+    def choose_shard(self, utt_id):
+        '''
+        choose the shard of an utterance with the sharding policy
+
+        Args:
+            utt_id: the utterance ID
+
+        Returns:
+            the shard number (1 to num_shards)
+        '''
+
+        if self.shard_by == 'roundrobin':
+            return self.num_written % self.num_shards + 1
+
+        if self.shard_by == 'speaker':
+            #the speakers are assigned round robin in order of appearance
+            speaker = self.utt2spk[utt_id]
+            if speaker not in self.spk_shards:
+                self.spk_shards[speaker] = (len(self.spk_shards)
+                                            % self.num_shards + 1)
+            return self.spk_shards[speaker]
+
+        return self.shard_by[utt_id]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def shard_path(path, shard):
+    '''
+    the path of a shard of a sharded archive or scp file
+
+    Args:
+        path: the path of the unsharded file, e.g. feats.ark
+        shard: the shard number
+
+    Returns:
+        the path of the shard, e.g. feats.1.ark
+    '''
+
+    root, ext = os.path.splitext(path)
+
+    return '%s.%d%s' % (root, shard, ext)
@@ -6,7 +6,11 @@
 
 from abc import ABCMeta, abstractmethod
 import gzip
+import hashlib
+import multiprocessing
+import traceback
 import numpy as np
+import ark
 
 ## Class that dispenses batches of data for mini-batch training
 class BatchDispenser(object):
@@ -28,7 +32,8 @@ class BatchDispenser(object):
                 - Value: The target sequence as a string
         '''
 
-    def __init__(self, feature_reader, target_coder, size, target_path):
+    def __init__(self, feature_reader, target_coder, size, target_path,
+                 rank=0, world_size=1):
         '''
         Abstract constructor for nonexisting general data sets.
 
@@ -39,17 +44,51 @@ class BatchDispenser(object):
             size: Specifies how many utterances should be contained
                   in each batch.
             target_path: path to the file containing the targets
+            rank: the index of the shard that is dispensed if the data is
+                divided over several processes
+            world_size: the number of shards, if larger than 1 the feature
+                reader is sharded (see FeatureReader.shard) and the dispenser
+                only uses the utterances in its shard. If the feature reader
+                is already sharded, the shard should be the same
         '''
 
-        #store the feature reader
+        #store the feature reader, only the shard of this process is read
         self.feature_reader = feature_reader
+        if world_size > 1:
+            if feature_reader.world_size == 1:
+                feature_reader.shard(rank, world_size)
+            elif (feature_reader.rank, feature_reader.world_size) != (
+                    rank, world_size):
+                raise Exception(
+                    'the feature reader is already sharded as shard %d of %d'
+                    % (feature_reader.rank, feature_reader.world_size))
 
         #get a dictionary connecting training utterances and targets.
-        self.target_dict = self.read_target_file(target_path)
+        target_dict = self.read_target_file(target_path)
+
+        #a sharded dispenser only keeps the targets of its shard, so the
+        #number of utterances and batches are those of the shard
+        if feature_reader.world_size > 1:
+            shard_utts = set(feature_reader.utt_ids)
+            target_dict = {utt_id: targets for utt_id, targets
+                           in target_dict.items() if utt_id in shard_utts}
+
+        #encode all the targets once and concatenate them in one array, the
+        #targets of an utterance are a slice of this array
+        self.target_index = {utt_id:i for i, utt_id in
+                             enumerate(target_dict.keys())}
+        encoded_targets = [target_coder.encode(targets)
+                           for targets in target_dict.values()]
+        self.target_offsets = np.concatenate(
+            [[0], np.cumsum([t.size for t in encoded_targets])]).astype(
+                np.int64)
+        self.targets = np.concatenate(
+            [np.zeros([0], np.int32)] + encoded_targets).astype(
+                np.uint16 if target_coder.num_labels <= 1 << 16
+                else np.int32)
 
         #detect the maximum length of the target sequences
-        self.max_target_length = max([target_coder.encode(targets).size
-                                      for targets in self.target_dict.values()])
+        self.max_target_length = int(np.diff(self.target_offsets).max())
 
         #store the batch size
         self.size = size
@@ -57,6 +96,19 @@ class BatchDispenser(object):
         #save the target coder
         self.target_coder = target_coder
 
+        #the batch index is created when it is needed
+        self._target_positions = None
+
+        #the utterances in the order of the archives, if this is set the
+        #utterances are shuffled in every epoch (see shuffle), or sorted in
+        #batches if sorted_batches is True (see sort_batches)
+        self.shuffle_base = None
+        self.sorted_batches = False
+        self.epoch = 0
+
+        #the fingerprint of the utterances is computed when it is needed
+        self._fingerprint = None
+
     def get_batch(self):
         '''
         Get a batch of features and targets.
@@ -67,29 +119,72 @@ class BatchDispenser(object):
                 - The targets: a list of target vectors
         '''
 
+        return self.read_utterances(self.size)
+
+    def read_utterances(self, num_utt):
+        '''
+        read the next utterances that have targets
+
+        Args:
+            num_utt: the number of utterances that are read
+
+        Returns:
+            A pair containing:
+                - The features: a list of feature matrices
+                - The targets: a list of target vectors
+        '''
+
         #set up the data lists.
         batch_inputs = []
         batch_targets = []
 
-        while len(batch_inputs) < self.size:
-            #read utterance
-            utt_id, utt_mat, _ = self.feature_reader.get_utt()
+        while len(batch_inputs) < num_utt:
+            num_missing = num_utt - len(batch_inputs)
 
-            #get transcription
-            if utt_id in self.target_dict and utt_mat is not None:
-                targets = self.target_dict[utt_id]
-                encoded_targets = self.target_coder.encode(targets)
+            #the utterances are reshuffled at the end of every epoch
+            if self.shuffle_base is not None:
+                if self.epoch_finished():
+                    self.start_epoch(self.epoch + 1)
+                num_missing = min(num_missing, len(self.feature_reader.utt_ids)
+                                  - self.feature_reader.position)
 
-                batch_inputs.append(utt_mat)
-                batch_targets.append(encoded_targets)
-            else:
-                if utt_id not in self.target_dict:
-                    print 'WARNING no targets for %s' % utt_id
-                if utt_mat is None:
-                    print 'WARNING %s is too short to splice' % utt_id
+            #read the utterances that are still missing in one bulk read
+            utts = self.feature_reader.get_utts(num_missing)
+
+            for utt_id, utt_mat, _ in utts:
+                #get transcription
+                if utt_id in self.target_index and utt_mat is not None:
+                    batch_inputs.append(utt_mat)
+                    batch_targets.append(self.get_targets(utt_id))
+                else:
+                    if utt_id not in self.target_index:
+                        print 'WARNING no targets for %s' % utt_id
+                    if utt_mat is None:
+                        print 'WARNING %s is too short to splice' % utt_id
+
+            #sorted batches are read in one piece and the last batch of an
+            #epoch can be smaller, so the batches stay aligned
+            if self.sorted_batches:
+                break
 
         return batch_inputs, batch_targets
 
+    def get_targets(self, utt_id):
+        '''
+        get the encoded targets of an utterance
+
+        Args:
+            utt_id: the utterance ID
+
+        Returns:
+            a read-only view of the encoded targets
+        '''
+
+        index = self.target_index[utt_id]
+
+        return self.targets[self.target_offsets[index]:
+                            self.target_offsets[index+1]]
+
 
     def split(self):
         '''
@@ -99,31 +194,407 @@ class BatchDispenser(object):
         the rest
         '''
         self.feature_reader.split()
+        self._target_positions = None
+        self._fingerprint = None
+
+        #the remaining utterances are shuffled starting from the first epoch
+        if self.shuffle_base is not None:
+            remaining = set(self.feature_reader.utt_ids)
+            self.shuffle_base = [utt_id for utt_id in self.shuffle_base
+                                 if utt_id in remaining]
+            self.start_epoch(0)
+
+    def shuffle(self, seed=0, block_size=1, buffer_size=1):
+        '''
+        shuffle the utterances in memory every epoch, reading starts at the
+        beginning of the first epoch
+
+        the utterances are put in the order of the archives (by archive and
+        offset). Blocks of consecutive utterances are shuffled and the
+        utterances are then shuffled within windows of buffer_size utterances,
+        so most reads stay close to each other in the archives.
+
+        Args:
+            seed: the seed for shuffling, the order of an epoch is the same for
+                the same seed so the training can be resumed
+            block_size: the number of consecutive utterances that are kept
+                together
+            buffer_size: the number of utterances in the windows that are
+                shuffled
+        '''
+
+        #the blocks are taken from the utterances in the order of the
+        #archives, so the reads in a block are sequential even if the order
+        #of the reader alternates between archives
+        reader = self.feature_reader.reader
+        if isinstance(reader, ark.ArkReader):
+            order = np.lexsort((reader.offsets, reader.files))
+        else:
+            order = np.argsort(reader.offsets, kind='mergesort')
+        self.shuffle_base = [self.feature_reader.utt_ids[i] for i in order]
+        self.sorted_batches = False
+        self._fingerprint = None
+        self.shuffle_seed = seed
+        self.shuffle_block_size = block_size
+        self.shuffle_buffer_size = buffer_size
+        self.start_epoch(0)
+
+    def epoch_order(self, epoch):
+        '''
+        compute the order of the utterances in an epoch
+
+        Args:
+            epoch: the index of the epoch
+
+        Returns:
+            the indices of the utterances in shuffle_base in the order of the
+            epoch
+        '''
+
+        random = np.random.RandomState([self.shuffle_seed, epoch])
+        num_utt = len(self.shuffle_base)
+
+        if self.sorted_batches:
+            #sort the utterances by length and cut them in batches
+            lengths = dict(zip(self.feature_reader.utt_ids,
+                               np.asarray(self.feature_reader.lengths)))
+            order = np.argsort([lengths[utt_id]
+                                for utt_id in self.shuffle_base],
+                               kind='mergesort')
+            batches = [order[i:i+self.size]
+                       for i in range(0, num_utt, self.size)]
+
+            #shuffle the full batches, the incomplete batch is the last one
+            full_batches = batches[:num_utt//self.size]
+            random.shuffle(full_batches)
+
+            return np.concatenate(full_batches + batches[len(full_batches):]
+                                  or [order])
+
+        #shuffle the blocks of consecutive utterances
+        block_size = self.shuffle_block_size
+        blocks = np.arange(0, num_utt, block_size)
+        random.shuffle(blocks)
+        order = (blocks[:, np.newaxis] + np.arange(block_size)).ravel()
+        order = order[order < num_utt]
+
+        #shuffle the utterances within every window
+        keys = (np.arange(num_utt)//self.shuffle_buffer_size
+                + random.random_sample(num_utt))
+
+        return order[np.argsort(keys, kind='mergesort')]
+
+    def start_epoch(self, epoch):
+        '''
+        put the utterances in the order of an epoch, reading starts at the
+        beginning of the epoch
+
+        Args:
+            epoch: the index of the epoch
+        '''
+
+        index = {utt_id: i for i, utt_id in
+                 enumerate(self.feature_reader.utt_ids)}
+        self.feature_reader.reorder([index[self.shuffle_base[i]]
+                                     for i in self.epoch_order(epoch)])
+        self._target_positions = None
+        self.epoch = epoch
+
+    def epoch_finished(self):
+        '''
+        check if all the utterances of the epoch have been read
+
+        Returns:
+            True if the utterances are shuffled every epoch and the reader is
+            at the end of the epoch
+        '''
+
+        return (self.shuffle_base is not None and
+                self.feature_reader.position >=
+                len(self.feature_reader.utt_ids))
+
+    @property
+    def target_positions(self):
+        '''the positions in the reader of the utterances that have targets,
+        this is the batch index that is used to move between batches without
+        reading the utterances'''
+
+        if self._target_positions is None:
+            self._target_positions = np.array(
+                [i for i, utt_id in enumerate(self.feature_reader.utt_ids)
+                 if utt_id in self.target_index], dtype=np.int64)
+
+        return self._target_positions
+
+    @property
+    def fingerprint(self):
+        '''a hash of the utterance IDs in the order the epochs are computed
+        from (the order of the reader if the utterances are not reshuffled
+        every epoch), the stored states are only valid for the same
+        fingerprint'''
+
+        if self._fingerprint is None:
+            if self.shuffle_base is None:
+                utt_ids = self.feature_reader.utt_ids
+            else:
+                utt_ids = self.shuffle_base
+            self._fingerprint = hashlib.md5(
+                '\n'.join(utt_ids)).hexdigest()
+
+        return self._fingerprint
 
     def skip_batch(self):
         '''skip a batch'''
 
-        skipped = 0
-        while skipped < self.size:
-            #read nex utterance
-            utt_id = self.feature_reader.next_id()
+        #sorted batches start at multiples of the batch size in every epoch
+        if self.sorted_batches:
+            if self.epoch_finished():
+                self.start_epoch(self.epoch + 1)
+            self.feature_reader.seek(min(
+                self.feature_reader.position + self.size,
+                len(self.feature_reader.utt_ids)))
+            return
+
+        positions = self.target_positions
+        if len(positions) == 0:
+            return
 
-            if utt_id in self.target_dict:
-                #update number skipped utterances
-                skipped += 1
+        #the number of utterances with targets before the reader position
+        read = np.searchsorted(positions, self.feature_reader.position)
+
+        #continue in the next epochs if the batch goes past the end of the
+        #epoch and the utterances are reshuffled
+        skip = self.size
+        while self.shuffle_base is not None and read + skip > len(positions):
+            skip -= len(positions) - read
+            self.start_epoch(self.epoch + 1)
+            positions = self.target_positions
+            read = 0
+
+        #move to the utterance after the last utterance of the batch
+        self.feature_reader.seek(
+            int(positions[(read + skip - 1) % len(positions)]) + 1)
 
     def return_batch(self):
         '''Reset to previous batch'''
 
-        skipped = 0
+        #sorted batches start at multiples of the batch size in every epoch,
+        #the batch before the start of the first epoch is the last batch of
+        #the first epoch
+        if self.sorted_batches:
+            position = self.feature_reader.position
+            if position == 0:
+                if self.epoch > 0:
+                    self.start_epoch(self.epoch - 1)
+                position = len(self.feature_reader.utt_ids)
+            self.feature_reader.seek(max(position - 1, 0)//self.size
+                                     *self.size)
+            return
+
+        positions = self.target_positions
+        if len(positions) == 0:
+            return
 
-        while skipped < self.size:
-            #read previous utterance
-            utt_id = self.feature_reader.prev_id()
+        #the number of utterances with targets before the reader position
+        read = np.searchsorted(positions, self.feature_reader.position)
 
-            if utt_id in self.target_dict:
-                #update number skipped utterances
-                skipped += 1
+        #go back to the previous epochs if the batch started in them and the
+        #utterances are reshuffled
+        skip = self.size
+        while self.shuffle_base is not None and read < skip and self.epoch > 0:
+            skip -= read
+            self.start_epoch(self.epoch - 1)
+            positions = self.target_positions
+            read = len(positions)
+
+        #move to the first utterance of the previous batch
+        self.feature_reader.seek(
+            int(positions[(read - skip) % len(positions)]))
+
+    def get_state(self):
+        '''
+        get the position of the dispenser in the data
+
+        the order of the utterances is not stored, it is recomputed from the
+        settings for shuffling or sorting every epoch. The fingerprint of the
+        utterances is stored to check that the state is restored for the same
+        data
+
+        Returns:
+            a dictionary of numpy arrays containing the fingerprint of the
+            utterances, the position of the reader, the epoch and the settings
+            for shuffling or sorting every epoch
+        '''
+
+        state = {'fingerprint': np.array(self.fingerprint),
+                 'position': np.array(self.feature_reader.position),
+                 'epoch': np.array(self.epoch)}
+
+        if self.shuffle_base is not None:
+            state.update({'sorted_batches': np.array(self.sorted_batches),
+                          'shuffle_seed': np.array(self.shuffle_seed)})
+            if not self.sorted_batches:
+                state.update(
+                    {'block_size': np.array(self.shuffle_block_size),
+                     'buffer_size': np.array(self.shuffle_buffer_size)})
+
+        return state
+
+    def set_state(self, state):
+        '''
+        go to a position in the data that was stored with get_state
+
+        Args:
+            state: the dictionary returned by get_state
+        '''
+
+        shuffled = 'shuffle_seed' in state
+        sorted_batches = shuffled and bool(state['sorted_batches'])
+
+        #put the utterances in the order the epochs were computed from if the
+        #stored state shuffles them differently
+        if self.shuffle_base is not None and (
+                not shuffled or sorted_batches != self.sorted_batches):
+            index = {utt_id: i for i, utt_id in
+                     enumerate(self.feature_reader.utt_ids)}
+            self.feature_reader.reorder([index[utt_id] for utt_id
+                                         in self.shuffle_base])
+            self._target_positions = None
+            self.shuffle_base = None
+            self.sorted_batches = False
+            self._fingerprint = None
+
+        #shuffle or sort the utterances the way the stored state does
+        if shuffled and self.shuffle_base is None:
+            if sorted_batches:
+                self.sort_batches(int(state['shuffle_seed']))
+            else:
+                self.shuffle(int(state['shuffle_seed']),
+                             int(state['block_size']),
+                             int(state['buffer_size']))
+
+        if str(state['fingerprint']) != self.fingerprint:
+            raise Exception('the stored dispenser state does not match the '
+                            'data')
+
+        #recompute the order of the stored epoch
+        if shuffled:
+            self.shuffle_seed = int(state['shuffle_seed'])
+            if not sorted_batches:
+                self.shuffle_block_size = int(state['block_size'])
+                self.shuffle_buffer_size = int(state['buffer_size'])
+            self.start_epoch(int(state['epoch']))
+        else:
+            self.epoch = int(state['epoch'])
+
+        self.feature_reader.seek(int(state['position']))
+
+    def save_state(self, filename):
+        '''
+        save the position of the dispenser in the data
+
+        Args:
+            filename: path of the .npz file where the state will be saved
+        '''
+
+        with open(filename, 'wb') as fid:
+            np.savez(fid, **self.get_state())
+
+    def restore_state(self, filename):
+        '''
+        go to a position in the data that was saved with save_state
+
+        Args:
+            filename: path of the .npz file containing the state
+        '''
+
+        with open(filename, 'rb') as fid:
+            stored = np.load(fid)
+            self.set_state({key: stored[key] for key in stored.files})
+
+    def sort_batches(self, seed=0):
+        '''
+        order the utterances so the batches contain utterances of similar
+        length
+
+        the utterances are sorted by length and cut into batches, the order of
+        the full batches is then shuffled in every epoch and an incomplete
+        batch is put at the end. Every epoch ends at the end of the last batch,
+        which can be smaller, so the batches stay aligned in every epoch.
+        Utterances without targets are removed so every batch is read in one
+        piece, reading starts at the beginning of the first epoch.
+
+        Args:
+            seed: the seed for shuffling the batches, the order of an epoch is
+                the same for the same seed so the training can be resumed
+        '''
+
+        #remove the utterances without targets
+        self.feature_reader.reorder(self.target_positions)
+        self._target_positions = None
+
+        self.shuffle_base = list(self.feature_reader.utt_ids)
+        self.sorted_batches = True
+        self._fingerprint = None
+        self.shuffle_seed = seed
+        self.start_epoch(0)
+
+    def batch_parts(self, batch_index):
+        '''
+        find the utterances of a batch without reading them, the batches are
+        counted from the start of the first epoch
+
+        Args:
+            batch_index: the index of the batch
+
+        Returns:
+            a list of pairs with an epoch (None if the utterances are not
+            reshuffled every epoch) and the indices in target_positions of the
+            utterances of the batch in that epoch
+        '''
+
+        num_targets = len(self.target_positions)
+
+        #sorted batches do not cross the end of an epoch
+        if self.sorted_batches:
+            epoch_batches = -(-num_targets//self.size)
+            begin = batch_index % epoch_batches*self.size
+            return [(batch_index//epoch_batches,
+                     np.arange(begin, min(begin + self.size, num_targets)))]
+
+        numbers = batch_index*self.size + np.arange(self.size)
+
+        if self.shuffle_base is None:
+            return [(None, numbers % num_targets)]
+
+        #split the batch in the parts of the epochs it contains
+        epochs = numbers//num_targets
+        return [(epoch, numbers[epochs == epoch] % num_targets)
+                for epoch in np.unique(epochs)]
+
+    def bucket_lengths(self, num_buckets):
+        '''
+        compute the maximal lengths of buckets that each contain about the same
+        number of utterances
+
+        Args:
+            num_buckets: the number of buckets
+
+        Returns:
+            a sorted list of maximal bucket lengths, the last one is the
+            maximal input length
+        '''
+
+        lengths = np.asarray(self.feature_reader.lengths)
+
+        if len(lengths) == 0:
+            return [self.max_input_length]
+
+        quantiles = np.percentile(
+            lengths, np.arange(1, num_buckets)*100.0/num_buckets)
+
+        return sorted(set([int(np.ceil(q)) for q in quantiles]
+                          + [self.max_input_length]))
 
     def compute_target_count(self):
         '''
@@ -133,13 +604,8 @@ class BatchDispenser(object):
             a numpy array containing the counts of the targets
         '''
 
-        #create a big vector of stacked encoded targets
-        encoded_targets = np.concatenate(
-            [self.target_coder.encode(targets)
-             for targets in self.target_dict.values()])
-
         #count the number of occurences of each target
-        count = np.bincount(encoded_targets,
+        count = np.bincount(self.targets,
                             minlength=self.target_coder.num_labels)
 
         return count
@@ -156,9 +622,10 @@ class BatchDispenser(object):
 
     @property
     def num_utt(self):
-        '''The number of utterances in the given data'''
+        '''The number of utterances in the given data (in the shard if the
+        data is sharded)'''
 
-        return len(self.target_dict)
+        return len(self.target_index)
 
     @property
     def num_labels(self):
@@ -205,14 +672,22 @@ class AlignmentBatchDispenser(BatchDispenser):
         read the file containing the state alignments
 
         Args:
-            target_path: path to the alignment file
+            target_path: path to the alignment file, either a gzipped text
+                archive or an scp file pointing to binary int32 vectors
 
         Returns:
             A dictionary containing
                 - Key: Utterance ID
-                - Value: The state alignments as a space seperated string
+                - Value: The state alignments as a space seperated string or as
+                    an integer numpy array for binary alignments
         '''
 
+        #binary alignments are already encoded as pdf IDs
+        if target_path.endswith('.scp'):
+            with ark.ArkReader(target_path) as reader:
+                return {utt_id: reader.read_utt_data(index)
+                        for index, utt_id in enumerate(reader.utt_ids)}
+
         target_dict = {}
 
         with gzip.open(target_path, 'rb') as fid:
@@ -221,3 +696,712 @@ class AlignmentBatchDispenser(BatchDispenser):
                 target_dict[splitline[0]] = ' '.join(splitline[1:])
 
         return target_dict
+
+class FrameBatchDispenser(AlignmentBatchDispenser):
+    '''a batch dispenser that dispenses minibatches of frames with their state
+    alignment targets instead of utterances. The frames of many utterances are
+    collected in a shuffle buffer, so the frames in a minibatch come from many
+    different utterances. This is only suited for classifiers that process
+    every frame independently (like the DNN).'''
+
+    def __init__(self, feature_reader, target_coder, size, target_path,
+                 buffer_size=500000, seed=0, rank=0, world_size=1):
+        '''
+        FrameBatchDispenser constructor
+
+        Args:
+            feature_reader: Kaldi ark-file feature reader instance.
+            target_coder: a TargetCoder object to encode and decode the target
+                sequences
+            size: the number of frames in each minibatch
+            target_path: path to the file containing the targets
+            buffer_size: the minimal number of frames in the shuffle buffer
+                when it is filled
+            seed: the seed for shuffling the buffer
+            rank: the index of the shard that is dispensed if the data is
+                divided over several processes
+            world_size: the number of shards
+        '''
+
+        super(FrameBatchDispenser, self).__init__(feature_reader, target_coder,
+                                                  size, target_path, rank,
+                                                  world_size)
+
+        self.buffer_size = buffer_size
+        self.random = np.random.RandomState(seed)
+
+        #the shuffled frames and targets in the buffer and the position of the
+        #first frame that has not been dispensed
+        self.buffer_inputs = None
+        self.buffer_targets = None
+        self.buffer_position = 0
+
+    def get_batch(self):
+        '''
+        Get a minibatch of frames and targets.
+
+        Returns:
+            A pair containing:
+                - The features: a [size, F] numpy array
+                - The targets: a [size] numpy array
+        '''
+
+        if (self.buffer_inputs is None or
+                self.buffer_inputs.shape[0] - self.buffer_position < self.size):
+            self.fill_buffer()
+
+        batch_inputs = self.buffer_inputs[self.buffer_position:
+                                          self.buffer_position + self.size]
+        batch_targets = self.buffer_targets[self.buffer_position:
+                                            self.buffer_position + self.size]
+        self.buffer_position += self.size
+
+        return batch_inputs, batch_targets
+
+    def get_utterances(self, num_utt):
+        '''
+        read whole utterances without the shuffle buffer, this is used to read
+        the validation set before the buffer is filled so it can be split off
+        at an utterance boundary
+
+        Args:
+            num_utt: the number of utterances that are read
+
+        Returns:
+            A pair containing:
+                - The features: an [N, F] numpy array with the frames of the
+                    utterances
+                - The targets: an [N] numpy array
+        '''
+
+        if self.buffer_inputs is not None:
+            raise Exception('whole utterances can only be read before the '
+                            'shuffle buffer is filled')
+
+        inputs, targets = self.read_utterances(num_utt)
+
+        #only keep the utterances whose alignment matches the features
+        matching = [i for i in range(len(inputs))
+                    if inputs[i].shape[0] == targets[i].shape[0]]
+        if len(matching) < len(inputs):
+            print ('WARNING %d alignments do not match the features'
+                   % (len(inputs) - len(matching)))
+
+        return (np.concatenate([inputs[i] for i in matching]),
+                np.concatenate([targets[i] for i in matching]).astype(
+                    np.int32))
+
+    def fill_buffer(self):
+        '''read utterances until the buffer is full and shuffle it'''
+
+        #keep the frames that have not been dispensed yet
+        if self.buffer_inputs is None:
+            inputs = []
+            targets = []
+        else:
+            inputs = [self.buffer_inputs[self.buffer_position:]]
+            targets = [self.buffer_targets[self.buffer_position:]]
+        num_frames = sum([i.shape[0] for i in inputs])
+
+        #read utterances until the buffer is full, stop when all utterances
+        #have been read once so the buffer contains no duplicates
+        while num_frames < max(self.buffer_size, self.size):
+
+            #the utterances are reshuffled at the end of every epoch
+            if self.epoch_finished():
+                if num_frames >= self.size:
+                    break
+                self.start_epoch(self.epoch + 1)
+
+            utt_id, utt_mat, looped = self.feature_reader.get_utt()
+
+            if looped and num_frames >= self.size:
+                self.feature_reader.prev_id()
+                break
+
+            if utt_id in self.target_index and utt_mat is not None:
+                encoded_targets = self.get_targets(utt_id)
+
+                if encoded_targets.shape[0] != utt_mat.shape[0]:
+                    print ('WARNING the alignment of %s does not match the '
+                           'features' % utt_id)
+                    continue
+
+                inputs.append(utt_mat)
+                targets.append(encoded_targets)
+                num_frames += utt_mat.shape[0]
+            else:
+                if utt_id not in self.target_index:
+                    print 'WARNING no targets for %s' % utt_id
+                if utt_mat is None:
+                    print 'WARNING %s is too short to splice' % utt_id
+
+        #shuffle the frames
+        order = self.random.permutation(num_frames)
+        self.buffer_inputs = np.concatenate(inputs)[order]
+        self.buffer_targets = np.concatenate(targets)[order].astype(np.int32)
+        self.buffer_position = 0
+
+    def split(self):
+        '''
+        split off the part that has allready been read by the batchdispenser
+
+        the validation set should be read with get_utterances, so the reader
+        is split at the last utterance of the validation set. The frames that
+        are still in the buffer are discarded, so no frames of the utterances
+        before the split are dispensed afterwards
+        '''
+
+        if (self.buffer_inputs is not None and
+                self.buffer_position < self.buffer_inputs.shape[0]):
+            print ('WARNING %d frames in the shuffle buffer are discarded by '
+                   'the split' % (self.buffer_inputs.shape[0]
+                                  - self.buffer_position))
+
+        super(FrameBatchDispenser, self).split()
+        self.buffer_inputs = None
+        self.buffer_targets = None
+        self.buffer_position = 0
+
+    def skip_batch(self):
+        '''skip a minibatch'''
+
+        self.get_batch()
+
+    def get_state(self):
+        '''
+        get the position of the dispenser in the data
+
+        Returns:
+            a dictionary of numpy arrays containing the position of the
+            dispenser (see BatchDispenser.get_state) and the state of the
+            random generator
+        '''
+
+        state = super(FrameBatchDispenser, self).get_state()
+        _, keys, position, has_gauss, gauss = self.random.get_state()
+        state.update({'random_keys': keys,
+                      'random_position': np.array(position),
+                      'random_has_gauss': np.array(has_gauss),
+                      'random_gauss': np.array(gauss)})
+
+        return state
+
+    def set_state(self, state):
+        '''
+        go to a position in the data that was stored with get_state, the frames
+        that were in the shuffle buffer are not dispensed
+
+        Args:
+            state: the dictionary returned by get_state
+        '''
+
+        super(FrameBatchDispenser, self).set_state(state)
+        self.random.set_state(('MT19937', state['random_keys'],
+                               int(state['random_position']),
+                               int(state['random_has_gauss']),
+                               float(state['random_gauss'])))
+        self.buffer_inputs = None
+        self.buffer_targets = None
+        self.buffer_position = 0
+
+    def return_batch(self):
+        '''the frames of a minibatch can not be returned to the shuffle buffer,
+        so the dispenser just continues with the next minibatch'''
+
+        pass
+
+    @property
+    def num_batches(self):
+        '''
+        The number of minibatches in the given data.
+
+        The number of batches is not necessarily a whole number
+        '''
+
+        lengths = np.asarray(self.feature_reader.lengths)
+
+        return float(sum([lengths[i] for i, utt_id in
+                          enumerate(self.feature_reader.utt_ids)
+                          if utt_id in self.target_index]))/self.size
+
+class ParallelBatchDispenser(object):
+    '''a batch dispenser that prepares the batches of another batch dispenser
+    in worker processes. Batch k contains the utterances k*size to
+    (k+1)*size - 1 (with targets, in reader order, counted over the epochs if
+    the utterances are reshuffled every epoch, see BatchDispenser.batch_parts)
+    and is prepared by worker k % num_workers, so every worker reads a
+    disjoint part of the data and the batches are the same for any number of
+    workers. The workers write the normalized and spliced features and the
+    encoded targets into a ring of shared memory slots and get_batch returns
+    views into these slots, which are only valid until the next call to
+    get_batch (copy them to keep them). Before the split the batches are read
+    by the wrapped dispenser, so the validation set can be read and split off
+    as usual. The workers are forked once by split, so split should be called
+    before a tensorflow session is created. Moving to another batch or
+    changing the order of the utterances afterwards is sent to the running
+    workers.'''
+
+    def __init__(self, dispenser, num_workers, depth=2):
+        '''
+        ParallelBatchDispenser constructor
+
+        Args:
+            dispenser: the BatchDispenser whose batches are prepared, its
+                feature reader should not prefetch
+            num_workers: the number of worker processes
+            depth: the number of batches every worker can prepare ahead
+        '''
+
+        if dispenser.feature_reader.prefetch > 0:
+            raise Exception('use either prefetching or worker processes')
+
+        self.dispenser = dispenser
+        self.num_workers = num_workers
+        self.depth = depth
+
+        #the workers are started by the split
+        self.is_split = False
+        self.workers = None
+
+        #the index of the next batch
+        self.batch_index = 0
+
+        #the shared memory slots, the slot whose views were handed out and
+        #the dimension of the features
+        self.slots = None
+        self.held_slot = None
+        self.dim = None
+
+    def get_batch(self):
+        '''
+        Get a batch of features and targets.
+
+        Returns:
+            A pair containing:
+                - The features: a list of feature matrices
+                - The targets: a list of target vectors
+        '''
+
+        if not self.is_split:
+            return self.dispenser.get_batch()
+
+        #the views into the previous slot are no longer used
+        if self.held_slot is not None:
+            self.slots[self.held_slot]['empty'].release()
+            self.held_slot = None
+
+        #wait for the worker to write the batch, batches that were written
+        #before the workers moved to another batch are thrown away
+        slot = self.slot_index(self.batch_index, self.first_batch)
+        meta = np.frombuffer(self.slots[slot]['meta'], dtype=np.int32)
+        while True:
+            while not self.slots[slot]['full'].acquire(timeout=1):
+                self.check_workers()
+
+            if meta[1] == self.batch_index and meta[2] == self.generation:
+                break
+
+            self.slots[slot]['empty'].release()
+
+        self.held_slot = slot
+        self.batch_index += 1
+
+        #create views into the slot
+        num_utt = meta[0]
+        input_lengths = meta[3:num_utt+3]
+        target_lengths = meta[self.dispenser.size+3:
+                              self.dispenser.size+num_utt+3]
+        frames = np.frombuffer(self.slots[slot]['inputs'], dtype=np.float32)
+        targets = np.frombuffer(self.slots[slot]['targets'], dtype=np.int32)
+        input_offsets = np.concatenate([[0], np.cumsum(input_lengths)])
+        target_offsets = np.concatenate([[0], np.cumsum(target_lengths)])
+
+        batch_inputs = [
+            frames[input_offsets[i]*self.dim:
+                   input_offsets[i+1]*self.dim].reshape([-1, self.dim])
+            for i in range(num_utt)]
+        batch_targets = [targets[target_offsets[i]:target_offsets[i+1]]
+                         for i in range(num_utt)]
+
+        return batch_inputs, batch_targets
+
+    def check_workers(self):
+        '''raise an exception if a worker failed or was killed'''
+
+        if not self.errors.empty():
+            error = self.errors.get()
+            self.stop()
+            raise Exception('a batch worker failed:\n%s' % error)
+
+        for worker, process in enumerate(self.workers):
+            if process.exitcode is not None:
+                self.stop()
+                raise Exception('batch worker %d stopped with exit code %d'
+                                % (worker, process.exitcode))
+
+    def slot_index(self, batch_index, first_batch):
+        '''
+        get the slot a batch is written to
+
+        Args:
+            batch_index: the index of the batch
+            first_batch: the batch the workers started at
+
+        Returns:
+            the index of the slot
+        '''
+
+        local_index = batch_index - first_batch
+        worker = local_index % self.num_workers
+
+        return (worker*self.depth
+                + (local_index//self.num_workers) % self.depth)
+
+    def start(self):
+        '''start the workers, they start at the current batch'''
+
+        feature_reader = self.dispenser.feature_reader
+        lengths = np.asarray(feature_reader.lengths)
+
+        #the utterances with targets in reader order
+        indices = self.dispenser.target_positions
+
+        #the feature dimension after normalizing and splicing
+        for index in indices:
+            utt_mat = feature_reader.load(index)
+            if utt_mat is not None:
+                self.dim = utt_mat.shape[1]
+                break
+
+        #a batch can hold at most the frames of the longest utterances, the
+        #targets can not be longer than the inputs. The meta data of a slot
+        #contains the number of utterances, the batch index, the generation
+        #and the input and target lengths
+        capacity = int(np.sum(np.sort(lengths[indices])[::-1]
+                              [:self.dispenser.size]))
+
+        self.slots = [
+            {'inputs': multiprocessing.RawArray('f', capacity*self.dim),
+             'targets': multiprocessing.RawArray('i', capacity),
+             'meta': multiprocessing.RawArray('i', 2*self.dispenser.size + 3),
+             'empty': multiprocessing.Semaphore(1),
+             'full': multiprocessing.Semaphore(0)}
+            for _ in range(self.num_workers*self.depth)]
+
+        #the workers restart at the first batch every time the generation
+        #changes, the number of actions counts the dispenser calls that were
+        #sent to every worker
+        self.generation = 0
+        self.first_batch = self.batch_index
+        self.num_actions = 0
+        self.control = multiprocessing.Array('l', [0, self.first_batch, 0])
+        self.actions = [multiprocessing.Queue()
+                        for _ in range(self.num_workers)]
+
+        self.held_slot = None
+        self.stop_event = multiprocessing.Event()
+        self.errors = multiprocessing.Queue()
+
+        self.workers = [multiprocessing.Process(
+            target=self.work, args=(worker,)) for worker in
+                        range(self.num_workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def seek(self, batch_index, action=None):
+        '''
+        move the workers to another batch
+
+        Args:
+            batch_index: the index of the next batch
+            action: a pair with the name of a dispenser method and its
+                arguments that was called on the dispenser, the workers call
+                it on their copy before they continue. This is needed when the
+                order of the utterances was changed
+        '''
+
+        self.batch_index = batch_index
+
+        if self.workers is None:
+            return
+
+        if action is not None:
+            for actions in self.actions:
+                actions.put(action)
+            self.num_actions += 1
+
+        self.generation += 1
+        self.first_batch = batch_index
+        with self.control.get_lock():
+            self.control[:] = [self.generation, batch_index, self.num_actions]
+
+    def work(self, worker):
+        '''
+        prepare batches, this runs in a worker process
+
+        Args:
+            worker: the index of the worker
+        '''
+
+        try:
+            feature_reader = self.dispenser.feature_reader
+            reader = feature_reader.reader
+
+            #don't share the file handles with the parent process
+            reader.close()
+
+            generation = 0
+            first_batch = self.first_batch
+            num_actions = 0
+            batch_index = first_batch + worker
+
+            while True:
+                #restart at the first batch if the workers were moved
+                with self.control.get_lock():
+                    control = list(self.control)
+                if control[0] != generation:
+                    generation, first_batch = control[:2]
+                    while num_actions < control[2]:
+                        name, args = self.actions[worker].get()
+                        getattr(self.dispenser, name)(*args)
+                        num_actions += 1
+                    batch_index = first_batch + worker
+
+                slot = self.slots[self.slot_index(batch_index, first_batch)]
+
+                #wait until the slot is empty
+                while not slot['empty'].acquire(timeout=0.1):
+                    if (self.stop_event.is_set()
+                            or self.control[0] != generation):
+                        break
+                else:
+                    self.write_batch(batch_index, generation, slot)
+                    batch_index += self.num_workers
+                    continue
+
+                if self.stop_event.is_set():
+                    return
+
+        except Exception: #pylint: disable=W0703
+            self.errors.put(traceback.format_exc())
+
+    def write_batch(self, batch_index, generation, slot):
+        '''
+        write a batch into a slot and mark it as full, this runs in a worker
+        process
+
+        Args:
+            batch_index: the index of the batch
+            generation: the generation of the workers the batch is written for
+            slot: the slot the batch is written to
+        '''
+
+        feature_reader = self.dispenser.feature_reader
+        reader = feature_reader.reader
+
+        inputs = np.frombuffer(slot['inputs'], dtype=np.float32)
+        targets = np.frombuffer(slot['targets'], dtype=np.int32)
+        meta = np.frombuffer(slot['meta'], dtype=np.int32)
+        input_position = 0
+        target_position = 0
+        num_utt = 0
+
+        #the utterances of the batch in the epochs it contains
+        for epoch, part in self.dispenser.batch_parts(batch_index):
+            #the worker reorders its own copy of the reader
+            if epoch is not None and epoch != self.dispenser.epoch:
+                self.dispenser.start_epoch(epoch)
+            indices = self.dispenser.target_positions[part]
+
+            for index, utt_mat in zip(indices, reader.read_many(indices)):
+                utt_id = reader.utt_ids[index]
+                utt_mat = feature_reader.process(utt_id, utt_mat)
+
+                #utterances that are too short to splice are left out
+                if utt_mat is None:
+                    continue
+
+                encoded_targets = self.dispenser.get_targets(utt_id)
+
+                inputs[input_position:input_position + utt_mat.size] = \
+                    utt_mat.ravel()
+                targets[target_position:
+                        target_position + encoded_targets.size] = \
+                    encoded_targets
+                input_position += utt_mat.size
+                target_position += encoded_targets.size
+                meta[num_utt+3] = utt_mat.shape[0]
+                meta[self.dispenser.size+num_utt+3] = encoded_targets.size
+                num_utt += 1
+
+        meta[:3] = [num_utt, batch_index, generation]
+        slot['full'].release()
+
+    def stop(self):
+        '''stop the workers'''
+
+        if self.workers is None:
+            return
+
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join(1)
+            if worker.is_alive():
+                worker.terminate()
+
+        self.workers = None
+        self.held_slot = None
+
+    def split(self):
+        '''
+        split off the part that has allready been read by the batchdispenser
+        and start the workers, which prepare the following batches
+        '''
+
+        self.dispenser.split()
+        self.is_split = True
+        self.batch_index = 0
+        self.start()
+
+    def skip_batch(self):
+        '''skip a batch'''
+
+        if not self.is_split:
+            self.dispenser.skip_batch()
+            return
+
+        self.seek(self.batch_index + 1)
+
+    def return_batch(self):
+        '''Reset to previous batch'''
+
+        if not self.is_split:
+            self.dispenser.return_batch()
+            return
+
+        self.seek(self.batch_index - 1)
+
+    def sort_batches(self, seed=0):
+        '''
+        order the utterances so the batches contain utterances of similar
+        length (see BatchDispenser.sort_batches)
+
+        Args:
+            seed: the seed for shuffling the batches
+        '''
+
+        self.dispenser.sort_batches(seed)
+        self.seek(0, ('sort_batches', (seed,)))
+
+    def shuffle(self, seed=0, block_size=1, buffer_size=1):
+        '''
+        shuffle the utterances in memory every epoch (see
+        BatchDispenser.shuffle)
+
+        Args:
+            seed: the seed for shuffling
+            block_size: the number of consecutive utterances that are kept
+                together
+            buffer_size: the number of utterances in the windows that are
+                shuffled
+        '''
+
+        self.dispenser.shuffle(seed, block_size, buffer_size)
+        self.seek(0, ('shuffle', (seed, block_size, buffer_size)))
+
+    def save_state(self, filename):
+        '''
+        save the position of the dispenser in the data
+
+        Args:
+            filename: path of the .npz file where the state will be saved
+        '''
+
+        state = self.dispenser.get_state()
+        state['batch_index'] = np.array(self.batch_index)
+
+        with open(filename, 'wb') as fid:
+            np.savez(fid, **state)
+
+    def restore_state(self, filename):
+        '''
+        go to a position in the data that was saved with save_state
+
+        Args:
+            filename: path of the .npz file containing the state
+        '''
+
+        with open(filename, 'rb') as fid:
+            stored = np.load(fid)
+            state = {key: stored[key] for key in stored.files}
+
+        self.dispenser.set_state(state)
+        self.seek(int(state['batch_index']), ('set_state', (state,)))
+
+    def bucket_lengths(self, num_buckets):
+        '''
+        compute the maximal lengths of buckets that each contain about the same
+        number of utterances (see BatchDispenser.bucket_lengths)
+
+        Args:
+            num_buckets: the number of buckets
+
+        Returns:
+            a sorted list of maximal bucket lengths
+        '''
+
+        return self.dispenser.bucket_lengths(num_buckets)
+
+    def compute_target_count(self):
+        '''
+        compute the count of the targets in the data
+
+        Returns:
+            a numpy array containing the counts of the targets
+        '''
+
+        return self.dispenser.compute_target_count()
+
+    def close(self):
+        '''stop the workers and close the feature reader'''
+
+        self.stop()
+        self.dispenser.feature_reader.close()
+
+    @property
+    def size(self):
+        '''the number of utterances in a batch'''
+
+        return self.dispenser.size
+
+    @property
+    def num_batches(self):
+        '''the number of batches in the given data'''
+
+        return self.dispenser.num_batches
+
+    @property
+    def num_utt(self):
+        '''The number of utterances in the given data'''
+
+        return self.dispenser.num_utt
+
+    @property
+    def num_labels(self):
+        '''the number of output labels'''
+
+        return self.dispenser.num_labels
+
+    @property
+    def max_input_length(self):
+        '''the maximal sequence length of the features'''
+
+        return self.dispenser.max_input_length
+
+    @property
+    def max_target_length(self):
+        '''the maximal sequence length of the targets'''
+
+        return self.dispenser.max_target_length
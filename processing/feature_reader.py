@@ -1,8 +1,13 @@
 '''@file feature_reader.py
 reading features and applying cmvn and splicing them'''
 
+import os
+import threading
+import Queue
 import ark
+import feature_store
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import readfiles
 
 class FeatureReader(object):
@@ -10,35 +15,102 @@ class FeatureReader(object):
     them (cmvn and splicing)'''
 
     def __init__(self, scpfile, cmvnfile, utt2spkfile,
-                 context_width, max_input_length):
+                 context_width, max_input_length, memmap=False, prefetch=0,
+                 splice_mode='zeros', cmvn_mode='speaker', cmvn_window=600,
+                 rank=0, world_size=1):
         '''
         create a FeatureReader object
 
         Args:
-            scpfile: path to the features .scp file
-            cmvnfile: path to the cmvn file
+            scpfile: path to the features .scp file or an rspecifier starting
+                with ark: to read the features sequentially from a stream (see
+                ark.ArkStreamReader), which does not support next_id, prev_id
+                and split, or the directory of a feature store (see
+                feature_store.convert)
+            cmvnfile: path to the cmvn file, in online cmvn mode the statistics
+                of all speakers are summed and used as prior, it can be None
+                in online mode
             utt2spkfile:path to the file containing the mapping from utterance
-                ID to speaker ID
+                ID to speaker ID, it can be None in online cmvn mode
             context_width: context width for splicing the features
             max_input_length: the maximum length of all the utterances in the
                 scp file
+            memmap: if True the feature archives are memory mapped
+            prefetch: the number of utterances that are read, normalized and
+                spliced ahead in a background thread, if 0 no prefetching is
+                done
+            splice_mode: how the utterances are padded for splicing, zeros or
+                edge (see splice), in zeros mode utterances that are too short
+                to splice are dropped
+            cmvn_mode: speaker to normalize with the statistics of the speaker
+                or online to normalize every frame with the statistics of a
+                sliding window of preceding frames (see OnlineCmvn)
+            cmvn_window: the window size in frames in online cmvn mode
+            rank: the index of the shard that is read if the utterances are
+                divided over several processes
+            world_size: the number of shards, if larger than 1 the reader only
+                reads its shard of the utterances (see shard)
         '''
 
-        #create the feature reader
-        self.reader = ark.ArkReader(scpfile)
+        if cmvn_mode not in ['speaker', 'online']:
+            raise Exception('unknown cmvn mode %s' % cmvn_mode)
 
-        #create a reader for the cmvn statistics
-        self.reader_cmvn = ark.ArkReader(cmvnfile)
+        #create the feature reader
+        if ark.is_rspecifier(scpfile):
+            self.reader = ark.ArkStreamReader(scpfile)
+        elif os.path.isdir(scpfile):
+            self.reader = feature_store.FeatureStoreReader(scpfile)
+        else:
+            self.reader = ark.ArkReader(scpfile, memmap=memmap)
+
+        #read the cmvn statistics of all speakers and precompute the cmvn
+        #transforms in a [num_speakers, 2, F] table with the scale and shift of
+        #every speaker
+        self.cmvn_mode = cmvn_mode
+        self.cmvn_window = cmvn_window
+        self.cmvn_prior = None
+        if cmvnfile is not None:
+            with ark.ArkReader(cmvnfile) as reader_cmvn:
+                self.spk_index = {spk:i for i, spk in
+                                  enumerate(reader_cmvn.utt_ids)}
+                spk_stats = reader_cmvn.read_many(
+                    range(len(reader_cmvn.utt_ids)))
+                self.cmvn_table = np.array(
+                    [cmvn_transform(stats) for stats in spk_stats],
+                    dtype=np.float32)
+
+            #the global statistics are the prior for online cmvn
+            if spk_stats:
+                self.cmvn_prior = np.sum(spk_stats, 0)
+        elif cmvn_mode == 'speaker':
+            raise Exception('speaker cmvn requires a cmvn file')
 
         #save the utterance to speaker mapping
-        self.utt2spk = readfiles.read_utt2spk(utt2spkfile)
+        if utt2spkfile is not None:
+            self.utt2spk = readfiles.read_utt2spk(utt2spkfile)
 
-        #store the context width
+        #store the context width and the padding mode
         self.context_width = context_width
+        self.splice_mode = splice_mode
 
         #store the max length
         self.max_input_length = max_input_length
 
+        #only keep the shard of this process
+        self.prefetch = prefetch
+        self.prefetcher = None
+        self.rank = 0
+        self.world_size = 1
+        if world_size > 1:
+            self.shard(rank, world_size)
+
+        #start the prefetching thread
+        if prefetch > 0:
+            if isinstance(self.reader, ark.ArkStreamReader):
+                raise Exception('prefetching is not supported for streams')
+            self.prefetcher = Prefetcher(self.load, len(self.reader.utt_ids),
+                                         prefetch)
+
     def get_utt(self):
         '''
         read the next features from the archive, normalize and splice them
@@ -47,17 +119,88 @@ class FeatureReader(object):
             the normalized and spliced features
         '''
 
+        #get the prefetched utterance, the position is kept in the reader
+        if self.prefetcher is not None:
+            if len(self.reader.utt_ids) == 0:
+                return None, None, True
+
+            index, looped = self.reader.next_index()
+
+            return (self.reader.utt_ids[index], self.prefetcher.get(index),
+                    looped)
+
         #read utterance
         (utt_id, utt_mat, looped) = self.reader.read_next_utt()
 
-        #apply cmvn
-        cmvn_stats = self.reader_cmvn.read_utt(self.utt2spk[utt_id])
-        utt_mat = apply_cmvn(utt_mat, cmvn_stats)
+        return utt_id, self.process(utt_id, utt_mat), looped
+
+    def get_utts(self, num_utt):
+        '''
+        read the next features of a number of utterances with one bulk read,
+        normalize and splice them
+
+        Args:
+            num_utt: the number of utterances that will be read
+
+        Returns:
+            a list containing a triple for every utterance with the utterance
+            ID, the normalized and spliced features and a bool that is true if
+            the reader looped back to the beginning
+        '''
+
+        #the prefetcher already reads ahead
+        if self.prefetcher is not None:
+            return [self.get_utt() for _ in range(num_utt)]
+
+        #read the utterances
+        utt_ids, utt_mats, looped = self.reader.read_next_utts(num_utt)
+
+        return [(utt_id, self.process(utt_id, utt_mat), utt_looped)
+                for utt_id, utt_mat, utt_looped in zip(utt_ids, utt_mats,
+                                                       looped)]
+
+    def process(self, utt_id, utt_mat):
+        '''
+        normalize and splice the features of an utterance
+
+        Args:
+            utt_id: the utterance ID
+            utt_mat: the features of the utterance, None if there are none
+                (e.g. at the end of a stream)
+
+        Returns:
+            the normalized and spliced features
+        '''
+
+        if utt_mat is None:
+            return None
+
+        #apply cmvn, half precision features are upcast
+        if self.cmvn_mode == 'online':
+            utt_mat = OnlineCmvn(self.cmvn_window, self.cmvn_prior)(utt_mat)
+        else:
+            transform = self.cmvn_table[self.spk_index[self.utt2spk[utt_id]]]
+            utt_mat = np.multiply(utt_mat, transform[0], dtype=np.float32)
+            utt_mat += transform[1]
 
         #splice the utterance
-        utt_mat = splice(utt_mat, self.context_width)
+        utt_mat = splice(utt_mat, self.context_width, mode=self.splice_mode)
+
+        return utt_mat
+
+    def load(self, index):
+        '''
+        read, normalize and splice the utterance at a position in the scp file
 
-        return utt_id, utt_mat, looped
+        Args:
+            index: the index of the utterance in the scp file
+
+        Returns:
+            the normalized and spliced features
+        '''
+
+        return self.process(self.reader.utt_ids[index],
+                            self.reader.read_utt_data(index))
 
     def next_id(self):
         '''
@@ -83,11 +226,245 @@ class FeatureReader(object):
 
         return self.reader.read_previous_scp()
 
+    @property
+    def position(self):
+        '''the position in the reader of the next utterance that will be
+        read'''
+
+        return self.reader.scp_position
+
+    def seek(self, position):
+        '''
+        move the reader to a position, the prefetcher follows the reader
+
+        Args:
+            position: the position of the next utterance that will be read
+        '''
+
+        self.reader.scp_position = position
+
     def split(self):
         '''split of the features that have been read so far'''
 
+        #the prefetcher can not read while the reader is changed
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+
         self.reader.split()
 
+        if self.prefetcher is not None:
+            self.prefetcher = Prefetcher(self.load, len(self.reader.utt_ids),
+                                         self.prefetch)
+
+    def reorder(self, order):
+        '''
+        change the order in which the utterances are read, reading starts at
+        the beginning of the new order
+
+        Args:
+            order: the indices of the utterances in the new order, utterances
+                that are not in the order will no longer be read
+        '''
+
+        #the prefetcher can not read while the reader is changed
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+
+        self.reader.reorder(order)
+
+        if self.prefetcher is not None:
+            self.prefetcher = Prefetcher(self.load, len(self.reader.utt_ids),
+                                         self.prefetch)
+
+    def shard(self, rank, world_size):
+        '''
+        only keep a shard of the utterances, the utterances are dealt to the
+        shards so every shard has about the same number of frames (see
+        shard_utterances). The shards of all ranks are disjoint and the same
+        in every process, reading starts at the beginning of the shard
+
+        Args:
+            rank: the index of the shard that is kept
+            world_size: the number of shards
+        '''
+
+        if isinstance(self.reader, ark.ArkStreamReader):
+            raise Exception('streams can not be sharded')
+
+        if not 0 <= rank < world_size:
+            raise Exception('rank %d is not in a world of size %d'
+                            % (rank, world_size))
+
+        self.reorder(shard_utterances(self.reader.lengths, world_size)[rank])
+        self.rank = rank
+        self.world_size = world_size
+
+    @property
+    def utt_ids(self):
+        '''the utterance IDs in the order they are read'''
+
+        return self.reader.utt_ids
+
+    @property
+    def lengths(self):
+        '''the number of frames of every utterance in the order they are
+        read'''
+
+        return self.reader.lengths
+
+    def close(self):
+        '''close the archive files that are kept open by the readers'''
+
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
+
+        self.reader.close()
+
+class Prefetcher(object):
+    '''Class that loads utterances in scp order in a background thread and
+    keeps them in a bounded queue. The utterances are loaded in order starting
+    from the first requested index and looping around at the end, if an index
+    is requested that is not the next one in order (because the reader moved)
+    the prefetcher restarts from the requested index.'''
+
+    def __init__(self, load, num_utt, size):
+        '''
+        Prefetcher constructor, starts the background thread
+
+        Args:
+            load: a function that loads the utterance at an index
+            num_utt: the number of utterances in the scp file
+            size: the maximal number of utterances that are loaded ahead
+        '''
+
+        self.load = load
+        self.num_utt = num_utt
+        self.queue = Queue.Queue(size)
+
+        #the loading restarts every time the generation changes
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.start_index = None
+        self.expected_index = None
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self, index):
+        '''
+        get the loaded utterance at an index
+
+        Args:
+            index: the index of the utterance in the scp file
+
+        Returns:
+            the loaded utterance
+        '''
+
+        if index != self.expected_index:
+            self.restart(index)
+
+        while True:
+            generation, loaded_index, data, error = self.queue.get()
+
+            #skip the utterances that were loaded before a restart
+            if generation != self.generation:
+                continue
+
+            if error is not None:
+                raise error
+
+            if loaded_index == index:
+                self.expected_index = (index + 1) % self.num_utt
+                return data
+
+    def restart(self, index):
+        '''
+        restart loading from an index
+
+        Args:
+            index: the index of the first utterance that will be loaded
+        '''
+
+        with self.condition:
+            self.generation += 1
+            self.start_index = index
+            self.expected_index = index
+            self.condition.notify()
+
+    def run(self):
+        '''load the utterances, this runs in the background thread'''
+
+        generation = None
+        index = None
+
+        while True:
+            with self.condition:
+                while self.start_index is None and not self.stopped:
+                    self.condition.wait()
+
+                if self.stopped:
+                    return
+
+                #restart from the requested index
+                if generation != self.generation:
+                    generation = self.generation
+                    index = self.start_index
+
+            try:
+                item = (generation, index, self.load(index), None)
+            except Exception as error: #pylint: disable=W0703
+                item = (generation, index, None, error)
+
+            #wait for room in the queue, unless a restart or stop is requested
+            while not self.stopped and generation == self.generation:
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+
+            index = (index + 1) % self.num_utt
+
+    def stop(self):
+        '''stop the background thread'''
+
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+        self.thread.join()
+
+def shard_utterances(lengths, world_size):
+    '''
+    deal utterances to shards so every shard has about the same number of
+    frames, the utterances are dealt from long to short and every utterance is
+    given to the shard with the fewest frames so far
+
+    Args:
+        lengths: the number of frames of every utterance
+        world_size: the number of shards
+
+    Returns:
+        a list with the indices of the utterances in every shard, in their
+        original order
+    '''
+
+    lengths = np.asarray(lengths, dtype=np.int64)
+    shard_frames = np.zeros([world_size], dtype=np.int64)
+    owners = np.zeros([len(lengths)], dtype=np.int64)
+
+    #the stable sort makes the shards the same in every process
+    for index in np.argsort(-lengths, kind='mergesort'):
+        owner = np.argmin(shard_frames)
+        owners[index] = owner
+        shard_frames[owner] += lengths[index]
+
+    return [np.nonzero(owners == rank)[0] for rank in range(world_size)]
+
 def apply_cmvn(utt, stats):
     '''
     apply mean and variance normalisation
@@ -105,16 +482,128 @@ def apply_cmvn(utt, stats):
         a numpy array containing the mean and variance normalized features
     '''
 
+    transform = cmvn_transform(stats)
+
+    #return mean and variance normalised utterance
+    return utt*transform[0] + transform[1]
+
+def cmvn_transform(stats):
+    '''
+    compute the affine transform that applies mean and variance normalisation
+
+    Args:
+        stats: a numpy array containing the mean and variance statistics (see
+            apply_cmvn)
+
+    Returns:
+        a [2, F] float32 numpy array containing the scale (1/std) and the shift
+        (-mean/std), so the normalised features are utt*scale + shift
+    '''
+
     #compute mean
     mean = stats[0, :-1]/stats[0, -1]
 
     #compute variance
     variance = stats[1, :-1]/stats[0, -1] - np.square(mean)
 
-    #return mean and variance normalised utterance
-    return np.divide(np.subtract(utt, mean), np.sqrt(variance))
+    scale = 1/np.sqrt(variance)
+
+    return np.array([scale, -mean*scale], dtype=np.float32)
+
+class OnlineCmvn(object):
+    '''Class that applies online mean and variance normalisation like the Kaldi
+    online cmvn. Every frame is normalised with the statistics of a sliding
+    window containing the frame and the frames before it, so no statistics of
+    the future are needed. As long as the window is not full it is completed
+    with a global prior. The features can be normalised in chunks as they
+    arrive, the object keeps the end of the previous chunk to compute the
+    window statistics, so use a new object (or call reset) for every
+    utterance.'''
 
-def splice(utt, context_width):
+    def __init__(self, window=600, prior=None, prior_frames=200,
+                 normalize_variance=True):
+        '''
+        OnlineCmvn constructor
+
+        Args:
+            window: the number of frames in the sliding window
+            prior: the global mean and variance statistics in the same format
+                as the speaker statistics (see apply_cmvn), if None no prior is
+                used
+            prior_frames: the maximal number of frames the prior counts for,
+                the prior is scaled to fill up the window up to this number of
+                frames
+            normalize_variance: if False only the mean is normalised
+        '''
+
+        self.window = window
+        self.prior = prior
+        self.prior_frames = prior_frames
+        self.normalize_variance = normalize_variance
+
+        #the last frames of the previous chunks
+        self.history = None
+
+    def reset(self):
+        '''forget the previous frames, e.g. for a new utterance'''
+
+        self.history = None
+
+    def __call__(self, chunk):
+        '''
+        normalise the next chunk of frames
+
+        Args:
+            chunk: a [T, F] numpy array containing the next frames
+
+        Returns:
+            a [T, F] float32 numpy array containing the normalised frames
+        '''
+
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if self.history is None:
+            self.history = np.zeros([0, chunk.shape[1]])
+
+        #the running sums over the history and the chunk
+        frames = np.concatenate([self.history, chunk])
+        cum_sum = np.concatenate([np.zeros([1, frames.shape[1]]),
+                                  np.cumsum(frames, 0)])
+        cum_square_sum = np.concatenate([np.zeros([1, frames.shape[1]]),
+                                         np.cumsum(np.square(frames), 0)])
+
+        #the statistics of the window ending at every frame of the chunk
+        ends = np.arange(len(self.history), len(frames)) + 1
+        begins = np.maximum(ends - self.window, 0)
+        count = (ends - begins).astype(np.float64)[:, np.newaxis]
+        feat_sum = cum_sum[ends] - cum_sum[begins]
+        square_sum = cum_square_sum[ends] - cum_square_sum[begins]
+
+        #fill up the window with the prior
+        if self.prior is not None and self.prior[0, -1] > 0:
+            prior_count = np.minimum(self.window - count, self.prior_frames)
+            weight = prior_count/self.prior[0, -1]
+            feat_sum += weight*self.prior[0, :-1]
+            square_sum += weight*self.prior[1, :-1]
+            count += prior_count
+
+        mean = feat_sum/count
+        normalized = chunk - mean
+
+        if self.normalize_variance:
+            variance = square_sum/count - np.square(mean)
+
+            #don't scale if there are not enough frames to estimate the
+            #variance
+            variance = np.where(variance > 1e-10, variance, 1)
+            normalized /= np.sqrt(variance)
+
+        #keep the frames that are still in the window of the next frame
+        self.history = frames[len(frames) - min(len(frames),
+                                                self.window - 1):]
+
+        return normalized.astype(np.float32)
+
+def splice(utt, context_width, out=None, mode='zeros'):
     '''
     splice the utterance
 
@@ -122,35 +611,43 @@ def splice(utt, context_width):
         utt: numpy matrix containing the utterance features to be spliced
         context_width: how many frames to the left and right should
             be concatenated
+        out: an optional C-contiguous float32 array of shape
+            [utt.shape[0], utt.shape[1]*(1+2*context_width)] where the spliced
+            features are written
+        mode: how the utterance is padded at the edges, options are zeros
+            (zero padding) and edge (the first and last frame are replicated
+            like Kaldi does)
 
     Returns:
-        a numpy array containing the spliced features, if the features are
-        too short to splice None will be returned
+        a numpy array containing the spliced features. In zeros mode None will
+        be returned if the features are too short to splice, in edge mode the
+        short utterances are padded
     '''
 
+    if mode not in ['zeros', 'edge']:
+        raise Exception('unknown splice mode %s' % mode)
+
     #return None if utterance is too short
-    if utt.shape[0]<1+2*context_width:
+    if mode == 'zeros' and utt.shape[0] < 1+2*context_width:
         return None
 
-    #create spliced utterance holder
-    utt_spliced = np.zeros(
-        shape=[utt.shape[0], utt.shape[1]*(1+2*context_width)],
-        dtype=np.float32)
-
-    #middle part is just the uttarnce
-    utt_spliced[:, context_width*utt.shape[1]:
-                (context_width+1)*utt.shape[1]] = utt
+    num_frames, dim = utt.shape
+    if out is None:
+        out = np.empty([num_frames, dim*(1+2*context_width)], dtype=np.float32)
 
-    for i in range(context_width):
+    if num_frames == 0:
+        return out
 
-        #add left context
-        utt_spliced[i+1:utt_spliced.shape[0],
-                    (context_width-i-1)*utt.shape[1]:
-                    (context_width-i)*utt.shape[1]] = utt[0:utt.shape[0]-i-1, :]
+    #pad the utterance so every frame has a full context window
+    padded = np.pad(np.asarray(utt, dtype=np.float32),
+                    ((context_width, context_width), (0, 0)),
+                    'constant' if mode == 'zeros' else 'edge')
 
-         #add right context
-        utt_spliced[0:utt_spliced.shape[0]-i-1,
-                    (context_width+i+1)*utt.shape[1]:
-                    (context_width+i+2)*utt.shape[1]] = utt[i+1:utt.shape[0], :]
+    #a view with the context window of every frame, the windows overlap in
+    #memory so nothing is copied until the view is written to the output
+    windows = as_strided(
+        padded, shape=(num_frames, 1+2*context_width, dim),
+        strides=(padded.strides[0], padded.strides[0], padded.strides[1]))
+    out.reshape(num_frames, 1+2*context_width, dim)[...] = windows
 
-    return utt_spliced
+    return out
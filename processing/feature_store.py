@@ -0,0 +1,320 @@
+'''@file feature_store.py
+contains a contiguous feature store, all the frames of all the utterances are
+stored in one memory mapped matrix so reading an utterance is a slice and
+frames can be accessed randomly'''
+
+import os
+import sys
+import numpy as np
+import ark
+
+class FeatureStoreReader(object):
+    '''
+    Class to read a feature store created with convert(). It has the same
+    interface as ark.ArkReader, so it can replace it in the FeatureReader. The
+    store is a directory containing four numpy files that are all memory
+    mapped: frames.npy with the frames of all utterances concatenated along
+    the first axis, utt_ids.npy with the utterance IDs and offsets.npy and
+    lengths.npy with the first frame and number of frames of every utterance.
+    The returned matrices are read-only views into the store, copy them if
+    they have to be modified.
+    '''
+
+    def __init__(self, store_dir):
+        '''
+        FeatureStoreReader constructor
+
+        Args:
+            store_dir: the directory containing the feature store
+        '''
+
+        self.store_dir = store_dir
+        self.frames = np.load(store_dir + '/frames.npy', mmap_mode='r')
+        self.utt_ids = np.load(store_dir + '/utt_ids.npy', mmap_mode='r')
+        self.offsets = np.load(store_dir + '/offsets.npy', mmap_mode='r')
+        self.lengths = np.load(store_dir + '/lengths.npy', mmap_mode='r')
+
+        self.scp_position = 0
+
+        #the hash index from utterance ID to position and the utterances
+        #sorted by their position in the frame matrix are only created when
+        #they are needed
+        self._utt_index = None
+        self._frame_order = None
+
+    @property
+    def utt_index(self):
+        '''hash index from utterance ID to position in the store'''
+
+        if self._utt_index is None:
+            self._utt_index = {utt_id:i for i, utt_id in
+                               enumerate(self.utt_ids.tolist())}
+
+        return self._utt_index
+
+    @property
+    def num_frames(self):
+        '''the total number of frames in the store'''
+
+        return int(self.lengths.sum())
+
+    def read_utt_data(self, index):
+        '''
+        read the frames of an utterance
+
+        Args:
+            index: index of the utterance that will be read
+
+        Returns:
+            a read-only view of the frames of the utterance
+        '''
+
+        begin = int(self.offsets[index])
+
+        return self.frames[begin:begin + int(self.lengths[index])]
+
+    def read_next_utt(self):
+        '''
+        read the next utterance in the store
+
+        Returns:
+            the utterance ID of the utterance that was read, the utterance data,
+            bool that is true if the reader looped back to the beginning
+        '''
+
+        if len(self.utt_ids) == 0:
+            return None, None, True
+
+        index, looped = self.next_index()
+
+        return self.utt_ids[index], self.read_utt_data(index), looped
+
+    def next_index(self):
+        '''
+        move to the next utterance in the store without reading it
+
+        Returns:
+            the index of the utterance in the store and a bool that is true if
+            the reader looped back to the beginning
+        '''
+
+        #if at end of file loop around
+        if self.scp_position >= len(self.utt_ids):
+            looped = True
+            self.scp_position = 0
+        else:
+            looped = False
+
+        self.scp_position += 1
+
+        return self.scp_position - 1, looped
+
+    def read_next_scp(self):
+        '''
+        read the next utterance ID but don't read the data
+
+        Returns:
+            the utterance ID of the utterance that was read
+        '''
+
+        #if at end of file loop around
+        if self.scp_position >= len(self.utt_ids):
+            self.scp_position = 0
+
+        self.scp_position += 1
+
+        return self.utt_ids[self.scp_position-1]
+
+    def read_previous_scp(self):
+        '''
+        read the previous utterance ID but don't read the data
+
+        Returns:
+            the utterance ID of the utterance that was read
+        '''
+
+        if self.scp_position < 0: #if at beginning of file loop around
+            self.scp_position = len(self.utt_ids) - 1
+
+        self.scp_position -= 1
+
+        return self.utt_ids[self.scp_position+1]
+
+    def read_utt(self, utt_id):
+        '''
+        read the data of a certain utterance ID
+
+        Returns:
+            the utterance data corresponding to the ID
+        '''
+
+        return self.read_utt_data(self.utt_index[utt_id])
+
+    def read_many(self, utts, packed=False, max_gap=None):
+        '''
+        read the data of many utterances
+
+        Args:
+            utts: a list of utterance IDs or indices in the store
+            packed: if True all the matrices are packed into one contiguous
+                array
+            max_gap: not used, the store does not need coalesced reads
+
+        Returns:
+            if packed is False a list of numpy arrays in the requested order,
+            otherwise a pair containing a numpy array with all matrices
+            concatenated along the first axis and a numpy array with the N+1
+            row offsets of the matrices in this array
+        '''
+
+        #pylint: disable=W0613
+
+        indices = [self.utt_index[utt] if isinstance(utt, basestring) else utt
+                   for utt in utts]
+
+        if not packed:
+            return [self.read_utt_data(index) for index in indices]
+
+        #gather all the frames with one fancy index
+        lengths = self.lengths[indices].astype(np.int64)
+        row_offsets = np.concatenate([[0], np.cumsum(lengths)])
+        frame_indices = (np.repeat(self.offsets[indices] - row_offsets[:-1],
+                                   lengths)
+                         + np.arange(row_offsets[-1]))
+
+        return self.frames[frame_indices], row_offsets
+
+    def read_next_utts(self, num_utt):
+        '''
+        read the next utterances in the store
+
+        Args:
+            num_utt: the number of utterances that will be read
+
+        Returns:
+            a list of utterance IDs, a list with the data of the utterances
+            and a list of bools that are true if the reader looped back to the
+            beginning before reading the utterance
+        '''
+
+        if len(self.utt_ids) == 0 or num_utt == 0:
+            return [None]*num_utt, [None]*num_utt, [True]*num_utt
+
+        indices, looped = zip(*[self.next_index() for _ in range(num_utt)])
+
+        return ([self.utt_ids[index] for index in indices],
+                self.read_many(indices), list(looped))
+
+    def read_frames(self, frame_indices):
+        '''
+        read frames at random positions in the store
+
+        Args:
+            frame_indices: the indices of the frames in the frame matrix
+
+        Returns:
+            a numpy array containing the frames and a numpy array containing
+            the index of the utterance every frame belongs to
+        '''
+
+        frame_indices = np.asarray(frame_indices, dtype=np.int64)
+
+        #the utterances are not necessarily in the order of the frame matrix
+        if self._frame_order is None:
+            self._frame_order = np.argsort(self.offsets, kind='mergesort')
+        utt_indices = self._frame_order[np.searchsorted(
+            self.offsets[self._frame_order], frame_indices, side='right') - 1]
+
+        return self.frames[frame_indices], utt_indices
+
+    def split(self):
+        '''Split of the data that was read so far'''
+
+        self.utt_ids = self.utt_ids[self.scp_position:]
+        self.offsets = self.offsets[self.scp_position:]
+        self.lengths = self.lengths[self.scp_position:]
+        self._utt_index = None
+        self._frame_order = None
+        self.scp_position = 0
+
+    def reorder(self, order):
+        '''
+        change the order of the utterances, the reader starts at the beginning
+        of the new order
+
+        Args:
+            order: the indices of the utterances in the new order, utterances
+                that are not in the order are removed from the reader
+        '''
+
+        order = np.asarray(order, dtype=np.int64)
+
+        self.utt_ids = self.utt_ids[order]
+        self.offsets = self.offsets[order]
+        self.lengths = self.lengths[order]
+        self._utt_index = None
+        self._frame_order = None
+        self.scp_position = 0
+
+    def close(self):
+        '''the store has no open files, the mappings are released when the
+        reader and the views into the store are deleted'''
+
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def convert(scp_path, store_dir, dtype=np.float32):
+    '''
+    convert the features in an scp file to a feature store
+
+    the frames are copied one utterance at a time into the memory mapped frame
+    matrix so the features do not have to fit in memory
+
+    Args:
+        scp_path: path to the .scp file
+        store_dir: the directory where the store will be created
+        dtype: the data type of the stored frames, np.float32 or np.float16
+    '''
+
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+
+    with ark.ArkReader(scp_path) as reader:
+
+        #the dimensions are known from the archive index
+        lengths = reader.rows.astype(np.int64)
+        if len(set(reader.cols.tolist())) > 1:
+            raise Exception('all the features in %s should have the same '
+                            'dimension' % scp_path)
+        dim = int(reader.cols[0]) if len(reader.cols) else 0
+        offsets = np.cumsum(lengths) - lengths
+
+        frames = np.lib.format.open_memmap(
+            store_dir + '/frames.npy', mode='w+', dtype=dtype,
+            shape=(int(lengths.sum()), dim))
+
+        for index in range(len(reader.utt_ids)):
+            frames[offsets[index]:offsets[index] + lengths[index]] = \
+                reader.read_utt_data(index)
+
+        frames.flush()
+        del frames
+
+        np.save(store_dir + '/utt_ids.npy', np.array(reader.utt_ids,
+                                                     dtype=np.str_))
+
+    np.save(store_dir + '/offsets.npy', offsets)
+    np.save(store_dir + '/lengths.npy', lengths)
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [3, 4]:
+        print 'usage: python feature_store.py feats.scp store_dir [float16]'
+        sys.exit(1)
+
+    convert(sys.argv[1], sys.argv[2],
+            np.float16 if sys.argv[3:] == ['float16'] else np.float32)
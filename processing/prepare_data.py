@@ -17,7 +17,11 @@ def prepare_data(datadir, featdir, conf, feat_type, dynamic):
     Args:
         datadir: directory where the kaldi data prep has been done
         featdir: directory where the features will be put
-        conf: feature configuration
+        conf: feature configuration, the compression option determines the
+            compressed matrix type of the archive (None, CM, CM2 or HM for
+            half precision) and the
+            num_shards option the number of archives the features are
+            distributed over (by speaker)
         featureType: string containing the type of features, optione are:
             fbank, mfcc and ssc.
         dynamic: the type of dynamic information added, options are:
@@ -36,10 +40,15 @@ def prepare_data(datadir, featdir, conf, feat_type, dynamic):
             seperate utterance'''
         found_segments = False
 
-    #create ark writer
-    if os.path.isfile(featdir + '/feats.ark'):
-        os.remove(featdir + '/feats.ark')
-    writer = ark.ArkWriter(featdir + '/feats.scp', featdir + '/feats.ark')
+    #create ark writer, the archive can be compressed with the kaldi matrix
+    #compression and sharded over multiple archives
+    num_shards = int(conf.get('num_shards', '1'))
+    remove_archives(featdir + '/feats.ark', num_shards)
+    compression = conf.get('compression', 'None')
+    writer = ark.ArkWriter(featdir + '/feats.scp', featdir + '/feats.ark',
+                           None if compression == 'None' else compression,
+                           num_shards=num_shards, shard_by='speaker',
+                           utt2spk=readfiles.read_utt2spk(datadir + '/utt2spk'))
 
     #read the wavfiles
     wavfiles = readfiles.read_wavfiles(datadir + '/wav.scp')
@@ -60,7 +69,7 @@ def prepare_data(datadir, featdir, conf, feat_type, dynamic):
                                      int(seg[2]*rate_utt[utt][0])],
                     rate_utt[utt][0])
 
-                writer.write_next_utt(featdir + '/feats.ark', seg[0], features)
+                writer.write_next_utt(seg[0], features)
                 max_length = max(max_length, features.shape[0])
         else:
             features = comp(rate_utt[utt][1], rate_utt[utt][0])
@@ -79,6 +88,22 @@ def prepare_data(datadir, featdir, conf, feat_type, dynamic):
     with open(featdir + '/maxlength', 'w') as fid:
         fid.write(str(max_length))
 
+def remove_archives(ark_path, num_shards=1):
+    '''
+    remove an archive and its shards so they can be written again
+
+    Args:
+        ark_path: path to the unsharded archive
+        num_shards: the number of shards of the archive
+    '''
+
+    paths = [ark_path] + [ark.shard_path(ark_path, shard)
+                          for shard in range(1, num_shards + 1)]
+
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
 def compute_cmvn(featdir):
     '''
     compute the cmvn statistics and save them
@@ -110,7 +135,9 @@ def compute_cmvn(featdir):
         for utt_id in split[2:len(split)]:
             spk_data = np.append(spk_data, reader.read_utt(utt_id), axis=0)
 
-        #compute mean and variance
+        #compute mean and variance, accumulated in double precision so half
+        #precision features don't overflow
+        spk_data = spk_data.astype(np.float64)
         stats = np.zeros([2, spk_data.shape[1]+1])
         stats[0, 0:spk_data.shape[1]] = np.sum(spk_data, 0)
         stats[1, 0:spk_data.shape[1]] = np.sum(np.square(spk_data), 0)
@@ -119,8 +146,70 @@ def compute_cmvn(featdir):
         #write stats to file
         writer.write_next_utt(split[0], stats)
 
+    reader.close()
     writer.close()
 
+def measure_precision_loss(featdir, compression='HM'):
+    '''
+    measure the error that is made by storing the features in feats.scp with
+    a lower precision matrix type
+
+    the error is measured on the features as they are stored and relative to
+    the standard deviation of every feature dimension, which is the error that
+    remains after cmvn
+
+    Args:
+        featdir: the directory containing the features in feats.scp
+        compression: the matrix type that is evaluated (HM, CM or CM2)
+
+    Returns:
+        a dictionary containing the maximal absolute error (max_error), the
+        root mean square error (rms_error), the maximal and root mean square
+        error relative to the feature standard deviation (max_relative_error
+        and rms_relative_error) and the signal to noise ratio in dB (snr)
+    '''
+
+    with ark.ArkReader(featdir + '/feats.scp') as reader:
+
+        max_error = 0.0
+        feat_sum = 0
+        feat_square_sum = 0
+        error_square_sum = 0
+        max_dim_error = 0
+        num_frames = 0
+
+        for index in range(len(reader.utt_ids)):
+            utt_mat = reader.read_utt_data(index).astype(np.float64)
+
+            #encode and decode the features
+            header, data = ark.encode(utt_mat, compression)
+            matrix_type, rows, cols = ark.parse_header(header + data)
+            error = ark.read_matrix(header + data, 0, matrix_type, rows,
+                                    cols) - utt_mat
+
+            max_error = max(max_error, np.abs(error).max())
+            feat_sum += np.sum(utt_mat, 0)
+            feat_square_sum += np.sum(np.square(utt_mat), 0)
+            error_square_sum += np.sum(np.square(error), 0)
+            max_dim_error = np.maximum(max_dim_error, np.abs(error).max(0))
+            num_frames += utt_mat.shape[0]
+
+    variance = feat_square_sum/num_frames - np.square(feat_sum/num_frames)
+    std = np.sqrt(np.maximum(variance, np.finfo(np.float32).tiny))
+
+    loss = {'max_error': max_error,
+            'rms_error': np.sqrt(error_square_sum.sum()/error_square_sum.size
+                                 /num_frames),
+            'max_relative_error': np.max(max_dim_error/std),
+            'rms_relative_error': np.sqrt(np.mean(error_square_sum/num_frames
+                                                  /np.square(std))),
+            'snr': 10*np.log10(feat_square_sum.sum()/error_square_sum.sum())}
+
+    for name in sorted(loss):
+        print '%s: %g' % (name, loss[name])
+
+    return loss
+
 def shuffle_examples(featdir):
     '''
     shuffle the utterances and put them in feats_shuffled.scp
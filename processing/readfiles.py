@@ -5,13 +5,15 @@ contains functions to read some files created by Kaldi
 import gzip
 from collections import OrderedDict
 import numpy as np
+import ark
 
 def read_alignments(filename):
     '''
     read the alignment file generated by kaldi
 
     Args:
-        filename: path to alignment file
+        filename: path to alignment file, either a gzipped text archive or an
+            scp file pointing to binary int32 vectors
 
     Returns:
         a dictionary containing:
@@ -19,6 +21,11 @@ def read_alignments(filename):
             - value: the alignments
     '''
 
+    if filename.endswith('.scp'):
+        with ark.ArkReader(filename) as reader:
+            return {utt_id: reader.read_utt_data(index)
+                    for index, utt_id in enumerate(reader.utt_ids)}
+
     with gzip.open(filename, 'rb') as fid:
         alignments = {}
         for line in fid:
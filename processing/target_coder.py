@@ -140,3 +140,20 @@ class AlignmentCoder(TargetCoder):
         alphabet = [str(target) for target in range(self.num_targets)]
 
         return alphabet
+
+    def encode(self, targets):
+        '''
+        encode a target sequence
+
+        Args:
+            targets: a string containing the state alignments or an integer
+                numpy array containing the pdf IDs, which are already encoded
+
+        Returns:
+            A numpy array containing the encoded targets
+        '''
+
+        if isinstance(targets, np.ndarray):
+            return targets.astype(np.uint32)
+
+        return super(AlignmentCoder, self).encode(targets)
@@ -0,0 +1,3 @@
+'''@package tests
+This package contains the unit tests
+'''
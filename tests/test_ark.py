@@ -0,0 +1,74 @@
+'''@file test_ark.py
+tests for the .ark io functionality'''
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import numpy as np
+from processing import ark
+
+#the alignment of the test utterance
+ALIGNMENT = [3, 7, 7, 1000]
+
+def kaldi_int32_vector(values):
+    '''
+    encode an int32 vector the way Kaldi's BasicVectorHolder writes it
+
+    Args:
+        values: the integer values
+
+    Returns:
+        a string containing the binary object
+    '''
+
+    data = ''.join(struct.pack('<bi', 4, value) for value in values)
+    return '\0B' + struct.pack('<bi', 4, len(values)) + data
+
+class Int32VectorTest(unittest.TestCase):
+    '''tests for the Kaldi int32 vector archives'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.ark_path = os.path.join(self.tmpdir, 'ali.ark')
+        self.scp_path = os.path.join(self.tmpdir, 'ali.scp')
+
+        #two utterances so the size of the first object matters
+        with open(self.ark_path, 'wb') as fid:
+            fid.write('utt1 ' + kaldi_int32_vector(ALIGNMENT))
+            pos = fid.tell() + len('utt2 ')
+            fid.write('utt2 ' + kaldi_int32_vector([5, 6]))
+        with open(self.scp_path, 'w') as fid:
+            fid.write('utt1 %s:5\n' % self.ark_path)
+            fid.write('utt2 %s:%d\n' % (self.ark_path, pos))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read(self):
+        '''the reader decodes Kaldi's int32 vectors'''
+
+        for memmap in [False, True]:
+            reader = ark.ArkReader(self.scp_path, memmap=memmap,
+                                   use_index=False)
+            self.assertEqual(reader.read_utt('utt1').tolist(), ALIGNMENT)
+            self.assertEqual(reader.read_utt('utt2').tolist(), [5, 6])
+            reader.close()
+
+    def test_read_stream(self):
+        '''the stream reader finds the end of Kaldi's int32 vectors'''
+
+        with ark.ArkStreamReader('ark:' + self.ark_path) as reader:
+            utts = [(utt_id, utt_mat.tolist()) for utt_id, utt_mat in reader]
+
+        self.assertEqual(utts, [('utt1', ALIGNMENT), ('utt2', [5, 6])])
+
+    def test_encode(self):
+        '''the writer produces the bytes Kaldi writes'''
+
+        header, data = ark.encode(np.array(ALIGNMENT))
+        self.assertEqual(header + data, kaldi_int32_vector(ALIGNMENT))
+
+if __name__ == '__main__':
+    unittest.main()